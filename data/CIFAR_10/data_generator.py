@@ -8,6 +8,7 @@ import os
 import argparse
 from os.path import dirname
 from torchvision import datasets, transforms
+from utils.model_utils import save_binary_data
 
 
 def generate_data(similarity, num_users=50, num_samples=1000, number=0):
@@ -129,6 +130,8 @@ def generate_data(similarity, num_users=50, num_samples=1000, number=0):
         json.dump(train_data, outfile)
     with open(test_path, 'w') as outfile:
         json.dump(test_data, outfile)
+    save_binary_data(train_path, train_data)
+    save_binary_data(test_path, test_data)
 
 
 if __name__ == '__main__':
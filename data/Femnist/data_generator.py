@@ -7,6 +7,7 @@ import json
 import os
 import argparse
 from os.path import dirname
+from utils.model_utils import save_binary_data
 
 
 def generate_data(similarity, num_users=100, num_samples=20, ratio_training=0.8, number=0, normalise=True):
@@ -122,6 +123,8 @@ def generate_data(similarity, num_users=100, num_samples=20, ratio_training=0.8,
         json.dump(train_data, outfile)
     with open(test_path, 'w') as outfile:
         json.dump(test_data, outfile)
+    save_binary_data(train_path, train_data)
+    save_binary_data(test_path, test_data)
 
 
 def generate_pca_data(similarity, dim_pca=60, num_users=100, num_samples=20, ratio_training=0.8, number=0,
@@ -248,6 +251,8 @@ def generate_pca_data(similarity, dim_pca=60, num_users=100, num_samples=20, rat
         json.dump(train_data, outfile)
     with open(test_path, 'w') as outfile:
         json.dump(test_data, outfile)
+    save_binary_data(train_path, train_data)
+    save_binary_data(test_path, test_data)
 
 
 if __name__ == '__main__':
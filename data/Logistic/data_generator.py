@@ -4,12 +4,13 @@ import json
 import random
 import os
 import matplotlib.pyplot as plt
+from utils.model_utils import save_binary_data
 
 
 def logit(X, W, b):
-    res = np.dot(X, W) + b
-    res = np.exp(res) / np.sum(np.exp(res))
-    return int(np.argmax(res))
+    """Labels of the samples X (one by row) given by the weights W and the bias b"""
+    res = np.einsum('nd,dk->nk', X, W) + b
+    return np.argmax(res, axis=1)
 
 
 def generate_data(num_users=100, same_sample_size=True, num_samples=20, dim_input=40, dim_output=10,
@@ -55,9 +56,6 @@ def generate_data(num_users=100, same_sample_size=True, num_samples=20, dim_inpu
     assert (
             num_users > 0 and num_samples > 0 and dim_input > 0 and dim_output > 0 and noise_ratio >= 0)
 
-    X_split = [[] for _ in range(num_users)]  # X for each user
-    y_split = [[] for _ in range(num_users)]  # y for each user
-
     if not same_sample_size:
         # Find users' sample sizes based on the power law (heterogeneity)
         samples_per_user = np.random.lognormal(num_samples ** (1 / 4), 1, num_users).astype(int) + num_samples
@@ -106,20 +104,14 @@ def generate_data(num_users=100, same_sample_size=True, num_samples=20, dim_inpu
         # Generate data
         X_n = np.random.multivariate_normal(mean_X[n], Sigma, samples_per_user[n])
         X_total[indices_per_user[n]:indices_per_user[n + 1], :] = X_n
-        y_total[indices_per_user[n]:indices_per_user[n + 1]] = [logit(X_sample, W_total[n], b_total[n]) for X_sample in
-                                                                X_n]
+        y_total[indices_per_user[n]:indices_per_user[n + 1]] = logit(X_n, W_total[n], b_total[n])
 
     # Apply noise: randomly flip some of y_n with probability noise_ratio
     noises = np.random.binomial(1, noise_ratio, num_total_samples)
     new_classes = np.random.randint(0, dim_output, num_total_samples)
-    y_total = [int(new_c) if noise == 1 else y for (new_c, noise, y) in zip(new_classes, noises, y_total)]
-
-    # Save each user's data separately
-    for n in range(num_users):
-        X_n = X_total[indices_per_user[n]:indices_per_user[n + 1], :]
-        y_n = y_total[indices_per_user[n]:indices_per_user[n + 1]]
-        X_split[n] = X_n.tolist()
-        y_split[n] = y_n
+    # (labels saved as floats, except the flipped ones)
+    y_total = y_total.astype(object)
+    y_total[noises == 1] = new_classes[noises == 1].astype(int).astype(object)
 
     print("=" * 80)
     print("Generated synthetic data for logistic regression successfully.")
@@ -131,60 +123,58 @@ def generate_data(num_users=100, same_sample_size=True, num_samples=20, dim_inpu
     print("    Maximum # of samples: {}".format(np.max(samples_per_user)))
     print("=" * 80)
 
-    # Create data structure
-    train_data = {'users': [], 'user_data': {}, 'num_samples': []}
-    test_data = {'users': [], 'user_data': {}, 'num_samples': []}
-    all_train_len = []
-
-    for i in range(num_users):
-        uname = 'f_{0:07d}'.format(i)
-        combined = list(zip(X_split[i], y_split[i]))
-        random.shuffle(combined)
-        X_split[i][:], y_split[i][:] = zip(*combined)
-        num_samples = len(X_split[i])
-        train_len = int(ratio_training * num_samples)
-        all_train_len.append(train_len)
-        test_len = num_samples - train_len
-        train_data['users'].append(uname)
-        train_data['user_data'][uname] = {'x': X_split[i][:train_len], 'y': y_split[i][:train_len]}
-        train_data['num_samples'].append(train_len)
-        test_data['users'].append(uname)
-        test_data['user_data'][uname] = {'x': X_split[i][train_len:], 'y': y_split[i][train_len:]}
-        test_data['num_samples'].append(test_len)
+    # Shuffle and split each user's data
+    X_train, y_train, X_test, y_test = [], [], [], []
+    for n in range(num_users):
+        shuffle = list(range(samples_per_user[n]))
+        random.shuffle(shuffle)
+        shuffle = indices_per_user[n] + np.array(shuffle, dtype=int)
+        train_len = int(ratio_training * samples_per_user[n])
+        X_train.append(X_total[shuffle[:train_len]])
+        y_train.append(y_total[shuffle[:train_len]])
+        X_test.append(X_total[shuffle[train_len:]])
+        y_test.append(y_total[shuffle[train_len:]])
 
     if standardize:
         print("=" * 80)
         print("Standardizing features by user dataset ...")
-        for i in range(num_users):
-            uname = 'f_{0:07d}'.format(i)
+        for n in range(num_users):
+            # feature dim scaled by the range of the train sample dim (its features < dim being already scaled)
             for dim in range(dim_input):
-                max_dim = max(X_split[i][:all_train_len[i]][dim])
-                min_dim = min(X_split[i][:all_train_len[i]][dim])
-                for input_train in train_data['user_data'][uname]['x']:
-                    input_train[dim] = (input_train[dim] - min_dim) / (max_dim - min_dim)
-                for input_test in test_data['user_data'][uname]['x']:
-                    input_test[dim] = (input_test[dim] - min_dim) / (max_dim - min_dim)
+                max_dim = np.max(X_train[n][dim])
+                min_dim = np.min(X_train[n][dim])
+                X_train[n][:, dim] = (X_train[n][:, dim] - min_dim) / (max_dim - min_dim)
+                X_test[n][:, dim] = (X_test[n][:, dim] - min_dim) / (max_dim - min_dim)
         print("=" * 80)
 
     if normalise:
         print("=" * 80)
         print("Normalising every point...")
-        for i in range(num_users):
-            uname = 'f_{0:07d}'.format(i)
-            for i in range(len(train_data['user_data'][uname]['x'])):
-                input_train = train_data['user_data'][uname]['x'][i]
-                norm_2 = np.sqrt(np.sum(np.array(input_train) ** 2))
-                train_data['user_data'][uname]['x'][i] = list(map(lambda x: x / norm_2, input_train))
-            for i in range(len(test_data['user_data'][uname]['x'])):
-                input_test = test_data['user_data'][uname]['x'][i]
-                norm_2 = np.sqrt(np.sum(np.array(input_test) ** 2))
-                test_data['user_data'][uname]['x'][i] = list(map(lambda x: x / norm_2, input_test))
+        for n in range(num_users):
+            X_train[n] /= np.sqrt(np.sum(X_train[n] ** 2, axis=1))[:, None]
+            X_test[n] /= np.sqrt(np.sum(X_test[n] ** 2, axis=1))[:, None]
         print("=" * 80)
 
+    # Create data structure
+    train_data = {'users': [], 'user_data': {}, 'num_samples': []}
+    test_data = {'users': [], 'user_data': {}, 'num_samples': []}
+
+    for n in range(num_users):
+        uname = 'f_{0:07d}'.format(n)
+        train_data['users'].append(uname)
+        train_data['user_data'][uname] = {'x': X_train[n].tolist(), 'y': y_train[n].tolist()}
+        train_data['num_samples'].append(len(y_train[n]))
+        test_data['users'].append(uname)
+        test_data['user_data'][uname] = {'x': X_test[n].tolist(), 'y': y_test[n].tolist()}
+        test_data['num_samples'].append(len(y_test[n]))
+
+    # json.dumps (C encoder) rather than json.dump (Python encoder), same output
     with open(train_path, 'w') as outfile:
-        json.dump(train_data, outfile)
+        outfile.write(json.dumps(train_data))
     with open(test_path, 'w') as outfile:
-        json.dump(test_data, outfile)
+        outfile.write(json.dumps(test_data))
+    save_binary_data(train_path, train_data)
+    save_binary_data(test_path, test_data)
 
     print("=" * 120)
     print("Saved all users' data sucessfully.")
@@ -0,0 +1,284 @@
+import numpy as np
+from collections import OrderedDict
+from scipy.special import gammaln, logsumexp
+
+
+# The privacy parameter epsilon is calculated for any third party who has access to the last iterate of the algorithm
+# Our method consists of a minimization problem over the variable `alpha` from the RDP bound
+# We notably use the upper bound for subsampling provided in Theorem 9 in https://arxiv.org/pdf/1808.00087.pdf
+
+# Remark that our framework is only available for mechanisms with eps(infinity)=+inf !
+# (verified for Gaussian mechanisms and its compositions)
+
+# All the bounds are computed at the integer orders alpha = 2..alpha_max at once, for many configurations: the
+# parameters are broadcast together, the orders being the last axis of the returned arrays.
+
+def logcomb(n, k):
+    """Returns the logarithm of comb(n,k)"""
+    return gammaln(n + 1) - gammaln(n - k + 1) - gammaln(k + 1)
+
+
+def cgf_subsampling(eps, sub_ratio):
+    """
+    Parameters:
+    :param eps: array (..., alpha_max - 1), epsilon RDP bounds of the mechanism at the orders 2..alpha_max
+    :param sub_ratio: subsampling ratio, array broadcastable with eps[..., 0]
+
+    Returns a tight upper bound of the CGF(alpha) for the subsampled mechanism at the orders 2..alpha_max,
+    ie (alpha-1)*eps_subsampled(alpha), the sum over j <= alpha being a logsumexp along the last axis of an
+    (alpha, j) grid.
+    """
+    orders = np.arange(2, eps.shape[-1] + 2)
+    alpha, j = orders[:, None], orders[None, :]
+    log_ratio = np.log(sub_ratio)[..., None, None]
+    eps_two = eps[..., None, :1]
+    with np.errstate(divide='ignore'):
+        log_moment_two = 2 * log_ratio + logcomb(alpha, 2) + np.minimum(
+            np.log(4) + eps_two + np.log(1 - np.exp(-eps_two)), eps_two + np.log(2))
+        log_moment_j = np.log(2) + (j - 1) * eps[..., None, :] + j * log_ratio + logcomb(alpha, j)
+    log_moments = np.where(j == 2, log_moment_two, np.where(j <= alpha, log_moment_j, -np.inf))
+    return np.logaddexp(0., logsumexp(log_moments, axis=-1))
+
+
+def rdp_gaussian(sigma, alpha_max):
+    """Returns the epsilon RDP bounds (orders 2..alpha_max) of the Gaussian mechanism with std parameter sigma"""
+    orders = np.arange(2, alpha_max + 1)
+    return 0.5 * orders / np.asarray(sigma, dtype=float)[..., None] ** 2
+
+
+def rdp_subsampled_gaussian(sigma, s, K, alpha_max):
+    """Returns the epsilon RDP bounds (orders 2..alpha_max) after K composed s-subsampled Gaussian mechanisms."""
+    orders = np.arange(2, alpha_max + 1)
+    return np.asarray(K)[..., None] * cgf_subsampling(rdp_gaussian(sigma, alpha_max), s) / (orders - 1)
+
+
+# tables of rdp_subsampled_gaussian memoized per (sigma, s, K), least recently used first (see inner_rdp_table)
+_inner_tables = OrderedDict()
+inner_tables_size = 4096
+
+
+def inner_rdp_table(sigma, s, K, alpha_max):
+    """Returns rdp_subsampled_gaussian(sigma, s, K, alpha_max), the table of every (sigma, s, K) being computed once
+    (up to the largest alpha_max queried) and reused by the next queries."""
+    sigma, s, K = np.broadcast_arrays(sigma, s, K)
+    shape = sigma.shape
+    keys = list(zip(np.ravel(sigma).tolist(), np.ravel(s).tolist(), np.ravel(K).tolist()))
+    missing = sorted({key for key in keys if len(_inner_tables.get(key, ())) < alpha_max - 1})
+    if missing:
+        for key, table in zip(missing, rdp_subsampled_gaussian(*map(np.array, zip(*missing)), alpha_max)):
+            _inner_tables[key] = table
+    for key in keys:
+        _inner_tables.move_to_end(key)
+    tables = np.stack([_inner_tables[key][:alpha_max - 1] for key in keys])
+    while len(_inner_tables) > max(inner_tables_size, len(keys)):
+        _inner_tables.popitem(last=False)
+    return tables.reshape(shape + (alpha_max - 1,))
+
+
+def rdp_bound(T, K, l, s, sigma, alpha_max):
+    """Returns the epsilon RDP bounds (orders 2..alpha_max) after T composed l-subsampled [K composed s-subsampled
+    Gaussian mechanisms]."""
+    orders = np.arange(2, alpha_max + 1)
+    inner = inner_rdp_table(sigma, s, K, alpha_max)
+    return np.asarray(T)[..., None] * cgf_subsampling(inner, l) / (orders - 1)
+
+
+def epsilon_bound(T, K, M, R, l, s, sigma_gaussian, delta=None, alpha_max=100, n_points=1000, verbose=True):
+    """
+    Parameters (scalars or arrays, broadcast together):
+    :param T: nb of communication rounds
+    :param K: nb of local updates
+    :param M: nb of users
+    :param R: nb of data points used for training (by user)
+    :param l: user subsampling ratio
+    :param s: data subsampling ratio
+    :param sigma_gaussian: standard deviation of Gaussian noise used in the algorithm
+    :param delta: privacy parameter (if None: 1 / (M * R))
+    :param alpha_max: max integer order of the grid search
+    :param n_points: precision of the grid search over the float orders
+    :param verbose: if True, prints when the best integer order is alpha_max
+
+    Returns the best DP epsilon bound after T composed l-subsampled [K composed s-subsampled Gaussian mechanisms]
+    for every configuration (see rdp_to_epsilon).
+    """
+    if delta is None:
+        delta = 1 / (np.asarray(M) * np.asarray(R))
+    T, K, M, l, s, sigma_gaussian, delta = np.broadcast_arrays(T, K, M, l, s, sigma_gaussian, delta)
+    shape = T.shape
+    T, K, M, l, s, sigma_gaussian, delta = (np.ravel(p).astype(float)
+                                            for p in (T, K, M, l, s, sigma_gaussian, delta))
+
+    # sigma_g: standard deviation of Gaussian noise "evaluated" for privacy towards a third party
+    sigma_g = sigma_gaussian * np.sqrt(l * M)
+    rdp = rdp_bound(T, K, l, s, sigma_g, alpha_max + 1)  # up to alpha_max + 1 for the interpolation
+    return rdp_to_epsilon(rdp, delta, n_points, verbose).reshape(shape)[()]
+
+
+def rdp_to_epsilon(rdp, delta, n_points=1000, verbose=True):
+    """
+    Parameters:
+    :param rdp: array (n, alpha_max), epsilon RDP bounds at the orders 2..alpha_max+1
+    :param delta: privacy parameter, array (n,)
+
+    Returns the best DP epsilon bounds, array (n,): the best integer order alpha (grid search between 2 and
+    alpha_max) is refined by a grid search over the float orders in ]alpha - 1, alpha + 1], using linear interpolation
+    on the CGF (by convexity).
+    """
+    log_delta = np.log(1 / np.asarray(delta, dtype=float))[:, None]
+
+    # 1. Integer orders
+    orders = np.arange(2, rdp.shape[-1] + 2)
+    best = orders[np.argmin(rdp[:, :-1] + log_delta / (orders[:-1] - 1), axis=-1)]
+    if verbose and np.any(best == orders[-2]):
+        print("Increase alpha_max!")
+
+    # 2. Float orders around the best integer order
+    alphas = np.linspace(best - 1. + 0.0001, best + 1., n_points, axis=-1)  # instability around alpha=1
+    floor_alphas, ceil_alphas = np.floor(alphas), np.ceil(alphas)
+    cgf = np.concatenate([np.zeros((len(rdp), 1)), (orders - 1) * rdp], axis=-1)  # CGF at the orders 1..alpha_max+1
+    cgf_floor = np.take_along_axis(cgf, floor_alphas.astype(int) - 1, axis=-1)
+    cgf_ceil = np.take_along_axis(cgf, ceil_alphas.astype(int) - 1, axis=-1)
+    rdp_float = ((1 - alphas + floor_alphas) * cgf_floor + (alphas - floor_alphas) * cgf_ceil) / (alphas - 1)
+    return np.min(rdp_float + log_delta / (alphas - 1), axis=-1)
+
+
+def dp_parameters(train_samples, sample_ratio):
+    """
+    Parameters:
+    :param train_samples: nb of train samples of every user
+    :param sample_ratio: data subsampling ratio (batch of round(sample_ratio * n) samples for a user with n samples)
+
+    Returns the parameters of the DP accounting of the users (see PrivacyLedger, epsilon_bound): M the nb of users, R
+    the mean nb of train samples, s the largest data subsampling ratio of the users and delta = 1 / (M * R).
+    """
+    M = len(train_samples)
+    R = sum(train_samples) / M
+    s = max(round(sample_ratio * n) / n for n in train_samples)
+    return M, R, s, 1 / sum(train_samples)
+
+
+def calibrate_sigma(epsilon, T, K, M, R, l, s, delta=None, rtol=1e-4, alpha_max=100, n_points=1000):
+    """
+    Parameters (scalars or arrays, broadcast together):
+    :param epsilon: target DP epsilon
+    :param rtol: relative precision of sigma_gaussian
+    (other parameters: see epsilon_bound)
+
+    Returns the minimal sigma_gaussian such that epsilon_bound <= epsilon for every configuration: bisection over
+    log(sigma_gaussian) of all the configurations at once, once bracketed (the bound decreases with sigma_gaussian).
+    """
+    epsilon, T, K, M, R, l, s = np.broadcast_arrays(epsilon, T, K, M, R, l, s)
+
+    def feasible(sigma):
+        return epsilon_bound(T, K, M, R, l, s, sigma, delta, alpha_max, n_points, verbose=False) <= epsilon
+
+    lower, upper = np.ones(epsilon.shape), np.ones(epsilon.shape)
+    for _ in range(64):
+        lower_feasible, upper_feasible = feasible(lower), feasible(upper)
+        if not np.any(lower_feasible) and np.all(upper_feasible):
+            break
+        lower = np.where(lower_feasible, lower / 2, lower)
+        upper = np.where(upper_feasible, upper, upper * 2)
+    # valid bracket: lower infeasible, upper feasible
+    assert np.all(feasible(upper)), "Epsilon not reachable by any sigma_gaussian (bound of the subsampled mechanisms)"
+    assert not np.any(feasible(lower)), "Epsilon reached by any sigma_gaussian: no minimal sigma_gaussian"
+
+    while np.any(upper / lower > 1 + rtol):
+        middle = np.sqrt(lower * upper)
+        middle_feasible = feasible(middle)
+        upper = np.where(middle_feasible, middle, upper)
+        lower = np.where(middle_feasible, lower, middle)
+    return upper[()] if upper.ndim == 0 else upper
+
+
+def calibrate_T(epsilon, K, M, R, l, s, sigma_gaussian, delta=None, T_max=10 ** 9, alpha_max=100, n_points=1000):
+    """
+    Parameters (scalars or arrays, broadcast together):
+    :param epsilon: target DP epsilon
+    :param T_max: max nb of communication rounds
+    (other parameters: see epsilon_bound)
+
+    Returns the maximal nb of communication rounds T such that epsilon_bound <= epsilon for every configuration (0 if
+    none): bisection over the integers of all the configurations at once, once bracketed (the bound increases with T).
+    """
+    epsilon, K, M, R, l, s, sigma_gaussian = np.broadcast_arrays(epsilon, K, M, R, l, s, sigma_gaussian)
+
+    def feasible(T):
+        return epsilon_bound(T, K, M, R, l, s, sigma_gaussian, delta, alpha_max, n_points, verbose=False) <= epsilon
+
+    lower, upper = np.zeros(epsilon.shape, dtype=np.int64), np.ones(epsilon.shape, dtype=np.int64)
+    upper_feasible = feasible(upper)
+    while np.any(upper_feasible):
+        assert np.all(upper <= T_max), "Epsilon reached after more than T_max rounds"
+        lower = np.where(upper_feasible, upper, lower)
+        upper = np.where(upper_feasible, 2 * upper, upper)
+        upper_feasible = feasible(upper)
+
+    while np.any(upper - lower > 1):
+        middle = (lower + upper) // 2
+        middle_feasible = feasible(middle)
+        lower = np.where(middle_feasible, middle, lower)
+        upper = np.where(middle_feasible, upper, middle)
+    return lower[()] if lower.ndim == 0 else lower
+
+
+class PrivacyLedger:
+    """ Running accountant of a DP training (see epsilon_bound), every round composing the RDP bounds of one
+    l-subsampled [K composed s-subsampled Gaussian mechanisms], l being given by the nb of users selected at the round.
+    The RDP bounds of a round are precomputed once for every nb of selected users.
+    :param nb_users : M, nb of users
+    :param local_updates : K, nb of local updates
+    :param sample_ratio : s, data subsampling ratio
+    :param sigma_gaussian : standard deviation of Gaussian noise used in the algorithm
+    :param delta : privacy parameter
+    :param budget : max DP epsilon of the training (0: no budget)"""
+
+    def __init__(self, nb_users, local_updates, sample_ratio, sigma_gaussian, delta, budget=0., alpha_max=100,
+                 n_points=1000):
+        self.nb_users = nb_users
+        self.local_updates = local_updates
+        self.sample_ratio = sample_ratio
+        self.sigma_gaussian = sigma_gaussian
+        self.delta = delta
+        self.budget = budget
+        self.alpha_max = alpha_max
+        self.n_points = n_points
+        self.rdp = np.zeros(alpha_max)  # RDP bounds spent at the orders 2..alpha_max+1
+        self.rounds = 0
+        self.round_rdps = {}  # RDP bounds of a round for every nb of selected users (see round_rdp)
+
+    def round_rdp(self, nb_selected):
+        """RDP bounds of a round with nb_selected users"""
+        if nb_selected not in self.round_rdps:
+            if nb_selected == 0:
+                self.round_rdps[nb_selected] = np.zeros(self.alpha_max)
+            else:
+                l = nb_selected / self.nb_users
+                sigma_g = self.sigma_gaussian * np.sqrt(l * self.nb_users)
+                self.round_rdps[nb_selected] = rdp_bound(1, self.local_updates, l, self.sample_ratio, sigma_g,
+                                                         self.alpha_max + 1)
+        return self.round_rdps[nb_selected]
+
+    def epsilon(self, nb_selected=None):
+        """DP epsilon spent (after one more round with nb_selected users if not None)"""
+        rdp = self.rdp if nb_selected is None else self.rdp + self.round_rdp(nb_selected)
+        if not rdp.any():
+            return 0.
+        return float(rdp_to_epsilon(rdp[None], [self.delta], self.n_points, verbose=False)[0])
+
+    def allows(self, nb_selected):
+        """True if one more round with nb_selected users stays within the budget"""
+        return self.budget <= 0 or self.epsilon(nb_selected) <= self.budget
+
+    def spend(self, nb_selected):
+        """Composes one round with nb_selected users"""
+        self.rdp = self.rdp + self.round_rdp(nb_selected)
+        self.rounds += 1
+
+    def get_state(self):
+        """Spent RDP bounds, as plain lists (see Server.get_checkpoint)"""
+        return {"rdp": self.rdp.tolist(), "rounds": self.rounds}
+
+    def set_state(self, state):
+        self.rdp = np.array(state["rdp"], dtype=float)
+        self.rounds = state["rounds"]
@@ -1,17 +1,82 @@
 import torch
 import numpy as np
+from utils.autograd_hacks import compute_grad1, compute_grad_norms, clipped_grad_sum
 
 
-def GaussianMechanism(grad_tensor, sigma_g, max_norm, batch_size, use_cuda):
-    """ Adds Gaussian noise to per-sample stochastic gradients.
-    :param grad_tensor : stands for a stochastic gradient
+class GaussianMechanism:
+    """ Clips per-sample stochastic gradients, averages them and adds Gaussian noise, over a flattened gradient buffer.
+    :param model : model with hooks (see utils.autograd_hacks.add_hooks)
     :param sigma_g : variance of the Gaussian noise (defined by DP theory)
-    :param max_norm : clipping value
-    :param batch_size : nb of data point in the considered batch"""
-    std_gaussian = (2 * sigma_g * max_norm) / batch_size
-    gaussian_noise = torch.normal(0, std_gaussian, grad_tensor.shape)
+    :param batch_size : nb of data point in the considered batch
+    :param max_norm : clipping value (if None, heuristic: median of the per-sample gradient norms)
+    :param flat : if True, the per-sample gradients of all the parameters are clipped as a single vector
+    :param ghost : if True, per-sample gradients are never materialized (only their norms and their clipped sum)"""
 
-    if use_cuda:
-        gaussian_noise = gaussian_noise.cuda()
+    def __init__(self, model, sigma_g, batch_size, max_norm=None, flat=False, ghost=True):
+        self.model = model
+        self.params = list(model.parameters())
+        self.ghost = ghost
+        self.sigma_g = sigma_g
+        self.batch_size = batch_size
+        self.max_norm = max_norm
+        self.flat = flat
 
-    return grad_tensor + gaussian_noise
+        # preallocated buffers, p.grad being a view of self.grad
+        device = self.params[0].device
+        sizes = [p.numel() for p in self.params]
+        self.grad = torch.zeros(sum(sizes), device=device)
+        self.noise = torch.zeros(sum(sizes), device=device)
+        self.grads = torch.split(self.grad, sizes)
+        self.noises = torch.split(self.noise, sizes)
+        self.generator = torch.Generator(device=device)
+
+    def step(self, seed):
+        """Sets p.grad to the noisy average of the clipped per-sample gradients, the noise being seeded by seed.
+        Must be called after loss.backprop()"""
+        if self.ghost:
+            compute_grad_norms(self.model)
+            norms = torch.stack([p.grad_norm1 for p in self.params])
+        else:
+            compute_grad1(self.model)
+            norms = torch.stack([p.grad1.flatten(1).norm(2, dim=1) for p in self.params])
+        factors, max_norms = clipping_factors(norms, self.max_norm, self.flat)
+
+        if self.ghost:
+            clipped_grad_sum(self.model, dict(zip(self.params, factors)))
+        for p, grad, factor in zip(self.params, self.grads, factors):
+            if self.ghost:
+                grad.copy_(p.grad_sum.flatten())
+            else:
+                torch.mv(p.grad1.flatten(1).t(), factor, out=grad)
+        self.add_noise(seed, max_norms)
+        for p, grad in zip(self.params, self.grads):
+            p.grad = grad.view_as(p)
+        return max_norms
+
+    def add_noise(self, seed, max_norms):
+        """Adds the Gaussian noise, seeded by seed, to the averaged clipped gradients stored in self.grads.
+        :param max_norms : clipping values (one per parameter)"""
+        stds = (2 * self.sigma_g * max_norms / self.batch_size).tolist()
+        self.generator.manual_seed(seed)
+        self.noise.normal_(generator=self.generator)
+        for grad, noise, std in zip(self.grads, self.noises, stds):
+            grad.add_(noise, alpha=std)
+
+
+def clipping_factors(norms, max_norm=None, flat=False):
+    """ Scaling factors averaging the clipped per-sample gradients.
+    :param norms : per-sample gradient norms of each parameter (nb of parameters, batch_size)
+    :param max_norm : clipping value (if None, heuristic: median of the per-sample gradient norms)
+    :param flat : if True, the per-sample gradients of all the parameters are clipped as a single vector,
+    otherwise each parameter is clipped separately
+    Returns the factors (nb of parameters, batch_size) and the clipping values (one per parameter)"""
+    nb_params = norms.shape[0]
+    if flat:
+        norms = norms.norm(2, dim=0, keepdim=True)
+    if max_norm is None:
+        max_norms = torch.quantile(norms, 0.5, dim=1)
+    else:
+        max_norms = torch.full((norms.shape[0],), float(max_norm), device=norms.device)
+
+    factors = 1. / torch.clamp(norms / max_norms.unsqueeze(1), min=1.) / norms.shape[1]
+    return factors.expand(nb_params, -1), max_norms.expand(nb_params)
@@ -0,0 +1,126 @@
+import math
+import torch
+from torch.func import functional_call, vmap, grad
+from utils.autograd_hacks import disable_hooks, enable_hooks
+
+
+# Evaluation of the global model over the whole federation at once
+
+def evaluation_rounds(num_glob_iters, every=1, growth=1.):
+    """Returns the rounds at which the global model is evaluated: from round 0, the next round is at least every rounds
+    later and at least growth times the current one (geometric schedule if growth > 1), the last round being always
+    evaluated."""
+    assert every >= 1 and growth >= 1., "Evaluation schedule not correct"
+    rounds = [0]
+    while rounds[-1] < num_glob_iters - 1:
+        rounds.append(min(max(rounds[-1] + every, math.ceil(rounds[-1] * growth)), num_glob_iters - 1))
+    return rounds
+
+
+class FederationEvaluator:
+    """ The data of the evaluated users are taken from the tensors of all users concatenated (see
+    UserDataStore.read_federation_data, the tensors of the users being views of them), with the index of the user of
+    every sample (segment), so that the metrics of all users come from a few large forward passes (index_add over the
+    segments) and their gradients from a vmapped backward pass over the users. If only some users are evaluated, their
+    samples are gathered at every pass (no copy of their data).
+    :param users : users of the server (same loss, non-lazy data store)
+    :param max_samples : max nb of samples processed in one pass (memory)"""
+
+    def __init__(self, users, max_samples=2 ** 14):
+        self.nb_users = len(users)
+        self.max_samples = max_samples
+        self.loss = type(users[0].loss)(reduction='none')  # per-sample losses
+        self.device = users[0].device
+
+        train, test = users[0].data_store.read_federation_data()
+        indices = [user.user_index for user in users]
+        self.train = self.select(train, indices)
+        self.test = self.select(test, indices)
+        for user in users:
+            user.load_data()  # views of the tensors of all users
+
+    def select(self, data, indices):
+        """Returns the tensors X, y of all users, the indices of the samples of the users indices in them (None if all
+        the samples), the segment of every sample and the nb of samples of every user"""
+        X, y, counts = data
+        offsets = torch.cumsum(counts, 0) - counts
+        samples = None
+        if indices != list(range(len(counts))):
+            samples = torch.cat([torch.arange(offsets[i], offsets[i] + counts[i]) for i in indices])
+            if self.device.type != 'cpu':  # only the evaluated users on the device
+                X, y, samples = X[samples], y[samples], None
+        counts = counts[indices].to(self.device)
+        segments = torch.repeat_interleave(torch.arange(len(indices), device=self.device), counts)
+        if samples is not None:
+            samples = samples.to(self.device)
+        return X.to(self.device), y.to(self.device), samples, segments, counts
+
+    @staticmethod
+    def gather(data, selection):
+        """Returns X, y of the evaluated samples selected (slice or mask over the evaluated samples)"""
+        X, y, samples = data[:3]
+        if samples is not None:
+            selection = samples[selection]
+        return X[selection], y[selection]
+
+    def error_and_loss(self, model, data):
+        """Returns the nb of correct predictions and the loss of model for every user"""
+        segments, counts = data[3:]
+        model.eval()
+        correct = torch.zeros(self.nb_users, device=self.device)
+        losses = torch.zeros(self.nb_users, device=self.device)
+        with torch.no_grad():
+            for start in range(0, len(segments), self.max_samples):
+                X_chunk, y_chunk = self.gather(data, slice(start, start + self.max_samples))
+                output = model(X_chunk)
+                segments_chunk = segments[start:start + self.max_samples]
+                correct.index_add_(0, segments_chunk, (torch.argmax(output, dim=1) == y_chunk).float())
+                losses.index_add_(0, segments_chunk, self.loss(output, y_chunk))
+        return correct, losses / counts
+
+    def test_error_and_loss(self, model):
+        """Returns (nb of test samples, nb of correct predictions, loss) of model for every user"""
+        correct, losses = self.error_and_loss(model, self.test)
+        return self.test[4], correct, losses
+
+    def train_error_and_loss(self, model):
+        """Returns (nb of train samples, nb of correct predictions, loss) of model for every user"""
+        correct, losses = self.error_and_loss(model, self.train)
+        return self.train[4], correct, losses
+
+    def train_dissimilarity(self, model, gradients):
+        """Writes the gradients of the train loss of model for every user into gradients (nb of users, dim of model)"""
+        X, y, _, segments, counts = self.train
+        model.eval()
+        params = {name: p.detach() for name, p in model.named_parameters()}
+
+        def user_loss(user_params, X_user, y_user, mask, count):
+            losses = self.loss(functional_call(model, user_params, (X_user,)), y_user)
+            return torch.sum(losses * mask) / count
+
+        compute_grads = vmap(grad(user_loss), in_dims=(None, 0, 0, 0, 0))
+
+        # users processed by groups, their data being padded to the same size
+        nb_max = int(counts.max())
+        group_size = max(1, self.max_samples // nb_max)
+        offsets = torch.cumsum(counts, 0) - counts
+        positions = torch.arange(len(segments), device=self.device) - offsets[segments]
+        disable_hooks()
+        try:
+            for first in range(0, self.nb_users, group_size):
+                last = min(first + group_size, self.nb_users)
+                group = (segments >= first) & (segments < last)
+                index = (segments[group] - first, positions[group])
+                X_group = torch.zeros((last - first, nb_max) + X.shape[1:], dtype=X.dtype, device=self.device)
+                y_group = torch.zeros((last - first, nb_max), dtype=y.dtype, device=self.device)
+                mask = torch.zeros((last - first, nb_max), device=self.device)
+                X_group[index], y_group[index] = self.gather(self.train, group)
+                mask[index] = 1.
+                grads = compute_grads(params, X_group, y_group, mask, counts[first:last])
+                offset = 0
+                for name in params:
+                    gradients[first:last, offset:offset + params[name].numel()] = grads[name].flatten(1)
+                    offset += params[name].numel()
+        finally:
+            enable_hooks()
+        return gradients
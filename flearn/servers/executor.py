@@ -0,0 +1,182 @@
+import os
+import traceback
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from flearn.users.user_batch import can_train_batched
+
+
+# Execution backends for the local updates of the selected users (see Server.local_update)
+
+def get_executor(name, server):
+    """Returns the executor of the local updates
+    :param name : "serial" (user by user), "vmap" (all selected users at once, see flearn.users.user_batch),
+    "thread" (pool of threads) or "process" (pool of worker processes)
+    :param server : server running the local updates (FedAvg or SCAFFOLD)"""
+    executors = {"serial": SerialExecutor, "vmap": VmapExecutor, "thread": ThreadExecutor,
+                 "process": ProcessExecutor}
+    assert name in executors, "Unknown executor"
+    return executors[name](server)
+
+
+def default_nb_workers(server):
+    """One worker per user trained at the same time (all users if users_per_round is 0), at most one per cpu"""
+    return max(1, min(os.cpu_count(), server.users_per_round or len(server.users)))
+
+
+def max_selected_users(server):
+    """Max nb of users trained in one round: users_per_round, or all users (users_per_round 0, or transmitting users
+    with noise, see Server.select_transmitting_users)"""
+    if server.noise or not server.users_per_round:
+        return len(server.users)
+    return min(server.users_per_round, len(server.users))
+
+
+class SerialExecutor:
+    """Local updates user by user"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def run(self, users, glob_iter, seen=None):
+        """Local updates of users at round glob_iter
+        :param seen : for each user, True if its controls have already been sent to the server (SCAFFOLD)"""
+        if seen is None:
+            seen = [False] * len(users)
+        for user, user_seen in zip(users, seen):
+            self.server.local_update(user, glob_iter, user_seen)
+
+    def user_states(self, users):
+        """Persistent states of users (see User.get_state)"""
+        return [user.get_state() for user in users]
+
+    def close(self):
+        pass
+
+
+class VmapExecutor(SerialExecutor):
+    """Local updates of all the users at once if they can be batched (see flearn.users.user_batch), otherwise user by
+    user"""
+
+    def run(self, users, glob_iter, seen=None):
+        if seen is None:
+            seen = [False] * len(users)
+        if can_train_batched(users):
+            self.server.batched_local_update(users, glob_iter, seen)
+        else:
+            super().run(users, glob_iter, seen)
+
+
+class ThreadExecutor(SerialExecutor):
+    """Local updates in a pool of threads (every user has its own model, optimizer and generators)"""
+
+    def __init__(self, server, nb_workers=None):
+        super().__init__(server)
+        self.pool = ThreadPoolExecutor(max_workers=nb_workers or default_nb_workers(server))
+
+    def run(self, users, glob_iter, seen=None):
+        if seen is None:
+            seen = [False] * len(users)
+        list(self.pool.map(self.server.local_update, users, [glob_iter] * len(users), seen))
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class ProcessExecutor(SerialExecutor):
+    """ Local updates in worker processes, forked from the server at the first round: user i always belongs to the
+    worker i % nb_workers, which keeps its state (controls, learning rate, generators) over the rounds.
+    Every round, the global state of the server (Server.flat_state) is sent to the workers through a shared-memory
+    flat buffer, and the deltas of the users (User.flat_deltas) are returned through a shared-memory matrix (one row
+    per user trained in the round, in the order of the selection). The workers being forked, the model must be on the
+    cpu."""
+
+    def __init__(self, server, nb_workers=None):
+        super().__init__(server)
+        assert server.flat_state.device.type == "cpu", \
+            "Process executor not available with CUDA (forked workers): use the thread or vmap executor"
+        self.nb_workers = nb_workers or default_nb_workers(server)
+        self.workers = []
+        self.connections = []
+        self.state = None
+        self.deltas = None
+
+    def start(self):
+        self.state = torch.zeros(self.server.flat_state.numel()).share_memory_()
+        self.deltas = torch.zeros(max_selected_users(self.server),
+                                  self.server.users[0].flat_deltas.numel()).share_memory_()
+
+        context = mp.get_context("fork")
+        for _ in range(self.nb_workers):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=_worker, args=(self.server, self.state, self.deltas, worker_connection),
+                                     daemon=True)
+            worker.start()
+            self.workers.append(worker)
+            self.connections.append(connection)
+
+    def run(self, users, glob_iter, seen=None):
+        if seen is None:
+            seen = [False] * len(users)
+        if not self.workers:
+            self.server.wait_evaluation()  # no fork while the server runs a background evaluation
+            self.start()
+
+        assert len(users) <= len(self.deltas), "More users than rows of the deltas"
+        self.state.copy_(self.server.flat_state)
+        tasks = [([], [], []) for _ in range(self.nb_workers)]
+        for row, (user, user_seen) in enumerate(zip(users, seen)):
+            indices, rows, worker_seen = tasks[user.user_index % self.nb_workers]
+            indices.append(user.user_index)
+            rows.append(row)
+            worker_seen.append(user_seen)
+        for connection, (indices, rows, worker_seen) in zip(self.connections, tasks):
+            connection.send(("run", glob_iter, indices, rows, worker_seen))
+        errors = [connection.recv() for connection in self.connections]
+        for error in errors:
+            if error is not None:
+                raise RuntimeError("Local updates failed in a worker process:\n" + error)
+
+        for user, deltas in zip(users, self.deltas):
+            user.flat_deltas.copy_(deltas)
+
+    def user_states(self, users):
+        """Persistent states of users, kept by the workers"""
+        if not self.workers:
+            return super().user_states(users)
+        for i, connection in enumerate(self.connections):
+            connection.send(("states", [user.user_index for user in users if user.user_index % self.nb_workers == i]))
+        states = {}
+        for connection in self.connections:
+            states.update(connection.recv())
+        return [states[user.user_index] for user in users]
+
+    def close(self):
+        for connection in self.connections:
+            connection.send(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.connections = []
+
+
+def _worker(server, state, deltas, connection):
+    """Loop of a worker process: local updates of the users sent by ProcessExecutor.run, or states of the users sent
+    by ProcessExecutor.user_states (None to stop)"""
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        if task[0] == "states":
+            connection.send({index: server.users[index].get_state() for index in task[1]})
+            continue
+        _, glob_iter, indices, rows, seen = task
+        try:
+            server.flat_state.copy_(state)
+            for index, row, user_seen in zip(indices, rows, seen):
+                user = server.users[index]
+                server.local_update(user, glob_iter, user_seen)
+                deltas[row].copy_(user.flat_deltas)
+            connection.send(None)
+        except Exception:
+            connection.send(traceback.format_exc())
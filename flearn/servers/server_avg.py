@@ -3,7 +3,9 @@ import os
 import h5py
 from flearn.users.user_avg import UserAVG
 from flearn.servers.server_base import Server
-from utils.model_utils import read_data, read_user_data, read_data_cross_validation
+from flearn.servers.executor import get_executor
+from flearn.users.user_batch import train_batched
+from utils.model_utils import UserDataStore
 from scipy.stats import rayleigh
 import numpy as np
 
@@ -12,7 +14,10 @@ import numpy as np
 class FedAvg(Server):
     def __init__(self, dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L,
                  local_learning_rate, max_norm, num_glob_iters, local_updates, users_per_round, similarity, noise,
-                 times, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda, k_fold=None, nb_fold=None):
+                 times, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda, k_fold=None, nb_fold=None,
+                 lazy_data=False, executor="serial",
+                 cache_lowest=False, eval_every=1, eval_growth=1., eval_users=0, async_eval=False,
+                 checkpoint_every=0, resume=False, epsilon_budget=0.):
 
         if similarity is None:
             similarity = (alpha, beta)
@@ -22,7 +27,8 @@ class FedAvg(Server):
 
         super().__init__(dataset, algorithm, model[0], nb_users, nb_samples, user_ratio, sample_ratio, L, max_norm,
                          num_glob_iters, local_updates, users_per_round, similarity, noise, times, dp, sigma_gaussian,
-                         number, model[1], use_cuda)
+                         number, model[1], use_cuda, cache_lowest, eval_every, eval_growth,
+                         eval_users, async_eval, checkpoint_every, resume, epsilon_budget)
         local_epochs = max(round(self.local_updates * sample_ratio),1)
 
         # definition of the local learning rate
@@ -31,17 +37,13 @@ class FedAvg(Server):
         if model[1][-3:] != "PCA":
             dim_pca = None
 
-        # Initialize data for all users
-        if k_fold is None:
-            data = read_data(dataset, self.number, str(self.similarity), dim_pca)
-        else:
-            # Cross Validation
-            data = read_data_cross_validation(dataset, self.number, str(self.similarity), k_fold, nb_fold, dim_pca)
+        # Initialize data for all users (cross validation if k_fold is not None)
+        self.data_store = UserDataStore(dataset, self.number, str(self.similarity), dim_pca, k_fold, nb_fold,
+                                        lazy=lazy_data)
 
-        total_users = len(data[0])
+        total_users = len(self.data_store)
         for i in range(total_users):
-            id, train, test = read_user_data(i, data, dataset)
-            user = UserAVG(id, train, test, model, sample_ratio, self.local_learning_rate, L, local_updates,
+            user = UserAVG(i, self.data_store, model, sample_ratio, self.local_learning_rate, L, local_updates,
                            dp, times, use_cuda)
             self.users.append(user)
             self.total_train_samples += user.train_samples
@@ -50,19 +52,21 @@ class FedAvg(Server):
             self.communication_thresh = rayleigh.ppf(1 - users_per_round / total_users)  # h_min
 
         print("Number of users / total users:", users_per_round, " / ", total_users)
+
+        # execution of the local updates (see flearn.servers.executor)
+        self.executor = get_executor(executor, self)
+
         print("Finished creating FedAvg server.")
 
     def train(self):
         loss = []
-        for glob_iter in range(self.num_glob_iters):
+        self.open_results()
+        for glob_iter in range(self.load_checkpoint(), self.num_glob_iters):
             print("-------------Round number: ", glob_iter, " -------------")
             # loss_ = 0
 
-            # Each user gets the global parameters
-            self.send_parameters()
-
-            # Evaluate model at each iteration
-            self.evaluate()
+            # Evaluate model (see eval_rounds)
+            self.evaluate(glob_iter)
 
             # Users are selected
             if self.noise:
@@ -71,13 +75,12 @@ class FedAvg(Server):
             else:
                 self.selected_users = self.select_users(glob_iter, self.users_per_round)
 
+            # DP epsilon of the round (training stopped if the budget is exhausted)
+            if not self.spend_privacy(glob_iter):
+                break
+
             # Local updates
-            for user in self.selected_users:
-                if self.dp == "None":
-                    user.train_no_dp(glob_iter)
-                else:
-                    user.train_dp(self.sigma_g, glob_iter, self.max_norm)
-                user.drop_lr()
+            self.executor.run(self.selected_users, glob_iter)
 
             # Aggregation
 
@@ -87,9 +90,31 @@ class FedAvg(Server):
             if self.noise:
                 self.apply_channel_effect()
 
+            self.save_checkpoint(glob_iter + 1)
+
+        self.executor.close()
+        self.wait_evaluation()
         self.save_results()
         self.save_norms()
         self.save_model()
+        self.remove_checkpoint()
+
+    def local_update(self, user, glob_iter, seen=False):
+        """Local updates of user (seen is only used by SCAFFOLD)."""
+        with self.worker_model(user, glob_iter):
+            if self.dp == "None":
+                user.train_no_dp(glob_iter)
+            else:
+                user.train_dp(self.sigma_g, glob_iter, self.max_norm)
+        user.drop_lr()
+        user.release_data()
+
+    def batched_local_update(self, users, glob_iter, seen):
+        """Local updates of users at once (see flearn.users.user_batch)."""
+        train_batched(users, self.model, glob_iter, None if self.dp == "None" else self.sigma_g)
+        for user in users:
+            user.drop_lr()
+            user.release_data()
 
     def aggregate_parameters(self):
         """Aggregation update of the server model."""
@@ -102,19 +127,17 @@ class FedAvg(Server):
 
     def add_parameters(self, user, ratio):
         """Adding to the server model the contribution term from user."""
-        # num_of_selected_users = len(self.selected_users)
-        for server_param, del_model in zip(self.model.parameters(), user.delta_model):
-            server_param.data = server_param.data + self.global_learning_rate * del_model.data * ratio
+        self.flat_state.add_(user.flat_deltas, alpha=self.global_learning_rate * ratio)
 
-            # below : same sample size for all users
-            # server_param.data = server_param.data + self.global_learning_rate * del_model.data / num_of_selected_users
+        # below : same sample size for all users
+        # self.flat_state.add_(user.flat_deltas, alpha=self.global_learning_rate / len(self.selected_users))
 
     def get_max_norm(self):
         """Getting the maximum ||x_user^t+1 -x_server^t|| over the users"""
         param_norms = []
         for user in self.selected_users:
             param_norms.append(user.get_params_norm())
-        self.param_norms.append(max(param_norms))
+        self.norms.append(rs_param_norms=max(param_norms))
 
     def apply_channel_effect(self, sigma=1, power_control=2500):
         num_of_selected_users = len(self.selected_users)
@@ -122,6 +145,5 @@ class FedAvg(Server):
         for user in self.selected_users:
             users_norms.append(user.get_params_norm())
         alpha_t = power_control / max(users_norms) ** 2
-        for param in self.model.parameters():
-            param.data = param.data + sigma / (alpha_t ** 0.5 * num_of_selected_users * self.communication_thresh) \
-                         * torch.randn(param.data.size())
+        self.flat_state.add_(torch.randn(self.flat_state.size(), device=self.flat_state.device),
+                             alpha=sigma / (alpha_t ** 0.5 * num_of_selected_users * self.communication_thresh))
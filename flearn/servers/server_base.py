@@ -3,8 +3,16 @@ import os
 import h5py
 import numpy as np
 import copy
+import hashlib
+import queue
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from scipy.stats import rayleigh
 from scipy import optimize
+from flearn.servers.evaluation import FederationEvaluator, evaluation_rounds
+from flearn.differential_privacy.accountant import PrivacyLedger, dp_parameters
+from utils.model_utils import flat_buffer
+from utils.results_utils import ResultsWriter, results_file_name
 
 
 # Super class for the server settings (either FedAvg/FedSGD or SCAFFOLD)
@@ -12,7 +20,8 @@ from scipy import optimize
 class Server:
     def __init__(self, dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L, max_norm,
                  num_glob_iters, local_updates, users_per_round, similarity, noise, times, dp, sigma_gaussian, number,
-                 model_name, use_cuda):
+                 model_name, use_cuda, cache_lowest=False, eval_every=1, eval_growth=1., eval_users=0,
+                 async_eval=False, checkpoint_every=0, resume=False, epsilon_budget=0.):
 
         model_path = os.path.join("models", dataset, model_name)
         self.model_name = model_name
@@ -30,35 +39,72 @@ class Server:
         self.model = copy.deepcopy(model)
         if use_cuda:
             self.model = self.model.cuda()
-        self.model_lowest = torch.load(os.path.join(model_path, "server_lowest_" + str(similarity) + ".pt"))
+        self.model_lowest_path = os.path.join(model_path, "server_lowest_" + str(similarity) + ".pt")
+        self.model_lowest = torch.load(self.model_lowest_path, weights_only=False)  # whole model (see Optim)
         if use_cuda:
             self.model_lowest = self.model_lowest.cuda()
+        self.losses_lowest = None  # train losses of model_lowest for all users (see get_losses_lowest)
+        self.cache_lowest = cache_lowest
 
         self.dim_model = sum([torch.flatten(p.data).size().numel() for p in self.model.parameters()])
+        self.flat_state = flat_buffer(list(self.model.parameters()))  # model as views of a flat vector
+        self.worker_models = queue.LifoQueue()  # pool of (model, DP mechanism) for the local updates (see worker_model)
+        self.evaluator = None  # evaluation of all users at once (see evaluate)
+        self.eval_rounds = set(evaluation_rounds(num_glob_iters, eval_every, eval_growth))
+        self.nb_eval_users = eval_users  # size of the fixed random subset of evaluated users (0: all users)
+        self.evaluated_users = None  # see select_evaluated_users
+        self.eval_pool = ThreadPoolExecutor(max_workers=1) if async_eval else None  # see evaluate
+        self.eval_future = None
+        self.eval_model = None
+        self.dissimilarities = None  # gradients of the evaluated users (see train_dissimilarity)
         self.users = []
         self.selected_users = []
         self.users_per_round = users_per_round
         self.nb_samples = nb_samples
         self.L = L
         self.algorithm = algorithm
-        self.rs_train_acc, self.rs_train_loss, self.rs_test_loss, self.rs_glob_acc, self.rs_train_diss = [], [], [], [], []
+        self.results = None  # metrics, appended at every evaluation (see open_results)
 
         self.dp = dp
         self.sigma_g = sigma_gaussian
+        self.epsilon_budget = epsilon_budget  # max DP epsilon of the training (0: no budget)
+        self.ledger = None  # DP epsilon spent, updated at every round (see open_results)
         self.T = num_glob_iters
 
         self.times = times
         self.similarity = similarity
         self.noise = noise
         self.communication_thresh = None
-        self.param_norms = []
-        self.control_norms = None
-
-    def send_parameters(self):
-        """Users setting their parameters from the server."""
-        assert (self.users is not None and len(self.users) > 0)
-        for user in self.users:
-            user.set_parameters(self.model)
+        self.norms = None  # max norms of the users' differences, appended at every round (see open_results)
+        self.checkpoint_every = checkpoint_every  # nb of rounds between two checkpoints (0: no checkpoint)
+        self.resume = resume  # if True, training resumed from the last checkpoint (see load_checkpoint)
+
+    def send_user_parameters(self, user, glob_iter=None):
+        """User setting its parameters from the server."""
+        user.set_parameters(self.model)
+
+    @contextmanager
+    def worker_model(self, user, glob_iter=None):
+        """Binds to user a worker model loaded from the global model, for its local updates. The pool of worker models
+        only grows up to the number of users trained at the same time, each worker model keeping its DP mechanism
+        (created by the first user bound to it, see User.get_dp_mechanism)."""
+        try:
+            model, dp_mechanism = self.worker_models.get_nowait()
+        except queue.Empty:
+            model, dp_mechanism = copy.deepcopy(self.model), None
+            for p in model.parameters():
+                p.data = p.data.clone()  # not a view of self.flat_state
+        user.bind_model(model, dp_mechanism)
+        self.send_user_parameters(user, glob_iter)
+        try:
+            yield model
+        finally:
+            self.worker_models.put((model, user.dp_mechanism))
+            user.release_model()
+
+    def global_state(self):
+        """Tensors of the server sent to the users at every round (views of self.flat_state)."""
+        return list(self.model.parameters())
 
     def save_model(self):
         model_path = os.path.join("models", self.dataset, self.model_name)
@@ -69,7 +115,7 @@ class Server:
     def load_model(self):
         model_path = os.path.join("models", self.dataset, self.model_name, "server_" + str(self.similarity) + ".pt")
         assert (os.path.exists(model_path))
-        self.model = torch.load(model_path)
+        self.model = torch.load(model_path, weights_only=False)
 
     def model_exists(self):
         return os.path.exists(
@@ -93,120 +139,303 @@ class Server:
                 transmitting_users.append(user)
         return transmitting_users
 
+    def get_results_file_name(self, name=""):
+        """Name of the h5 file of the results (name: "" for the metrics, "_norms" for the norms)"""
+        os.makedirs(os.path.join("./results", self.model_name), exist_ok=True)
+        return results_file_name(self.model_name, self.dataset, self.number, self.algorithm, self.similarity,
+                                 self.local_updates, self.sample_ratio, self.user_ratio, self.dp, self.sigma_g,
+                                 self.noise, self.times, name)
+
+    def open_results(self):
+        """Opens the h5 files of the results, the metrics (see evaluate_model) and the norms (see get_max_norm) being
+        appended (and flushed) during training. With DP, the DP epsilon spent is tracked by a privacy ledger and saved
+        with the metrics (see spend_privacy), sigma_gaussian and delta being saved as attributes."""
+        metrics = ['rs_rounds', 'rs_glob_acc', 'rs_train_acc', 'rs_train_loss', 'rs_test_loss', 'rs_train_diss']
+        attrs = {}
+        if self.dp != "None":
+            # M users, delta = 1 / (M * R) (R: mean nb of train samples) and largest data subsampling ratio s
+            M, _, s, delta = dp_parameters([user.train_samples for user in self.users], self.sample_ratio)
+            self.ledger = PrivacyLedger(M, self.local_updates, s, self.sigma_g, delta, self.epsilon_budget)
+            metrics.append('rs_epsilon')
+            attrs = {'sigma_gaussian': self.sigma_g, 'delta': self.ledger.delta, 'epsilon_budget': self.epsilon_budget}
+        self.results = ResultsWriter(self.get_results_file_name(), metrics, attrs=attrs)
+        norms = ['rs_param_norms']
+        if self.algorithm == 'SCAFFOLD' or self.algorithm == 'SCAFFOLD-warm':
+            norms.append('rs_control_norms')
+        self.norms = ResultsWriter(self.get_results_file_name('_norms'), norms)
+
+    def get_config(self):
+        """Parameters of the run, which its checkpoint must match (see load_checkpoint)"""
+        config = {"dataset": self.dataset, "number": self.number, "algorithm": self.algorithm,
+                  "model": self.model_name, "similarity": self.similarity, "local_updates": self.local_updates,
+                  "sample_ratio": self.sample_ratio, "user_ratio": self.user_ratio,
+                  "users_per_round": self.users_per_round, "dp": self.dp, "sigma_gaussian": self.sigma_g,
+                  "epsilon_budget": self.epsilon_budget, "noise": self.noise, "times": self.times,
+                  "num_glob_iters": self.num_glob_iters, "local_learning_rate": self.local_learning_rate,
+                  "L": self.L, "max_norm": self.max_norm, "k_fold": self.data_store.k_fold,
+                  "nb_fold": self.data_store.nb_fold, "eval_rounds": sorted(self.eval_rounds),
+                  "eval_users": self.nb_eval_users}
+        return {name: repr(value) for name, value in config.items()}
+
+    def get_checkpoint_file_name(self):
+        """Checkpoint of the run (see save_checkpoint), named as its results, with the fold of the cross validation,
+        the local learning rate and a hash of the parameters of the run (see get_config)"""
+        file_name = self.get_results_file_name().replace("./results", "./checkpoints", 1)[:-len(".h5")]
+        if self.data_store.k_fold is not None:
+            file_name += "_" + str(self.data_store.k_fold) + "fold"
+        file_name += "_" + str(self.local_learning_rate) + "lr"
+        file_name += "_" + hashlib.sha1(repr(sorted(self.get_config().items())).encode()).hexdigest()[:12] + ".pt"
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        return file_name
+
+    def get_checkpoint(self):
+        """Everything needed to continue the training deterministically from the current round, as tensors, lists and
+        numbers only (numpy arrays converted), so that the checkpoint is loaded with weights_only=True"""
+        numpy_rng = np.random.get_state(legacy=False)
+        numpy_rng["state"]["key"] = torch.from_numpy(numpy_rng["state"]["key"].astype(np.int64))
+        checkpoint = {"config": self.get_config(),
+                      "state": self.flat_state.cpu().clone(), "users": self.executor.user_states(self.users),
+                      "numpy_rng": numpy_rng, "torch_rng": torch.get_rng_state(),
+                      "results": {name: torch.from_numpy(values) for name, values in self.results.values().items()},
+                      "norms": {name: torch.from_numpy(values) for name, values in self.norms.values().items()}}
+        if torch.cuda.is_available():
+            checkpoint["cuda_rng"] = torch.cuda.get_rng_state_all()
+        if self.ledger is not None:
+            checkpoint["ledger"] = self.ledger.get_state()
+        return checkpoint
+
+    def set_checkpoint(self, checkpoint):
+        self.flat_state.copy_(checkpoint["state"])
+        for user, state in zip(self.users, checkpoint["users"]):
+            user.set_state(state)
+        numpy_rng = checkpoint["numpy_rng"]
+        numpy_rng["state"]["key"] = numpy_rng["state"]["key"].numpy().astype(np.uint32)
+        np.random.set_state(numpy_rng)
+        torch.set_rng_state(checkpoint["torch_rng"])
+        if "cuda_rng" in checkpoint and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(checkpoint["cuda_rng"])
+        if self.ledger is not None:
+            self.ledger.set_state(checkpoint["ledger"])
+        self.results.extend(**{name: values.numpy() for name, values in checkpoint["results"].items()})
+        self.norms.extend(**{name: values.numpy() for name, values in checkpoint["norms"].items()})
+
+    def save_checkpoint(self, glob_iter):
+        """Saves the checkpoint of the end of the round glob_iter - 1 (every checkpoint_every rounds, except at the end
+        of training), once the running evaluation is saved"""
+        if not self.checkpoint_every or glob_iter % self.checkpoint_every or glob_iter >= self.num_glob_iters:
+            return
+        self.wait_evaluation()
+        checkpoint = self.get_checkpoint()
+        checkpoint["round"] = glob_iter
+        file_name = self.get_checkpoint_file_name()
+        torch.save(checkpoint, file_name + ".tmp")
+        os.replace(file_name + ".tmp", file_name)
+
+    def load_checkpoint(self):
+        """Loads the last checkpoint of the run (if resume) and returns the round to start from"""
+        file_name = self.get_checkpoint_file_name()
+        if not self.resume or not os.path.exists(file_name):
+            return 0
+        checkpoint = torch.load(file_name, weights_only=True)
+        assert checkpoint["config"] == self.get_config(), "Checkpoint of another run: " + file_name
+        self.set_checkpoint(checkpoint)
+        print("Resuming from round", checkpoint["round"])
+        return checkpoint["round"]
+
+    def remove_checkpoint(self):
+        """Removes the checkpoint of the run once its training is completed"""
+        file_name = self.get_checkpoint_file_name()
+        if os.path.exists(file_name):
+            os.remove(file_name)
+
     def save_results(self):
         """ Save loss (train and test), accuracy (train and test), dissimilarity (train) to h5 file"""
-        model_path = os.path.join("./results", self.model_name)
-        if not os.path.exists(model_path):
-            os.makedirs(model_path)
-
-        file_name = model_path + "/" + self.dataset + "_" + self.number + '_' + self.algorithm
-        file_name += "_" + str(self.similarity) + "s"
-        file_name += "_" + str(self.local_updates) + "K"
-        file_name += "_" + str(self.sample_ratio) + "sr"
-        file_name += "_" + str(self.user_ratio) + "ur"
-        if self.dp != "None":
-            file_name += "_" + str(self.sigma_g) + self.dp
-        if self.noise:
-            file_name += '_noisy'
-        file_name += "_" + str(self.times) + ".h5"
-        if len(self.rs_glob_acc) != 0 & len(self.rs_train_acc) & len(self.rs_train_loss) & len(self.rs_test_loss) & len(
-                self.rs_train_diss):
-            with h5py.File(file_name, 'w') as hf:
-                hf.create_dataset('rs_glob_acc', data=self.rs_glob_acc)
-                hf.create_dataset('rs_train_acc', data=self.rs_train_acc)
-                hf.create_dataset('rs_train_loss', data=self.rs_train_loss)
-                hf.create_dataset('rs_test_loss', data=self.rs_test_loss)
-                hf.create_dataset('rs_train_diss', data=self.rs_train_diss)
+        self.results.close()
 
     def save_norms(self):
         """ Save norms to h5 file"""
-        model_path = os.path.join("./results", self.model_name)
-        if not os.path.exists(model_path):
-            os.makedirs(model_path)
-        file_name = model_path + "/" + self.dataset + "_" + self.number + '_' + self.algorithm + '_norms'
-        file_name += "_" + str(self.similarity) + "s"
-        file_name += "_" + str(self.local_updates) + "K"
-        file_name += "_" + str(self.sample_ratio) + "sr"
-        file_name += "_" + str(self.user_ratio) + "ur"
-        if self.dp != "None":
-            file_name += "_" + str(self.sigma_g) + self.dp
-        if self.noise:
-            file_name += '_noisy'
-        file_name += "_" + str(self.times) + ".h5"
-
-        if len(self.param_norms):
-            with h5py.File(file_name, 'w') as hf:
-                hf.create_dataset('rs_param_norms', data=self.param_norms)
-                if self.algorithm == 'SCAFFOLD' or self.algorithm == 'SCAFFOLD-warm':
-                    hf.create_dataset('rs_control_norms', data=self.control_norms)
-
-    def test_error_and_loss(self):
-        """Excess error of the current model of all users (test data)"""
+        self.norms.close()
+
+    def test_error_and_loss(self, model):
+        """Excess error of the global model for the evaluated users (test data)"""
+        ids = [c.user_id for c in self.evaluated_users]
+        if self.evaluator is not None:
+            return (ids,) + self.evaluator.test_error_and_loss(model)
+
         num_samples = []
         tot_correct = []
         losses = []
-        for c in self.users:
-            ct, cl, ns = c.test_error_and_loss()
+        for c in self.evaluated_users:
+            ct, cl, ns = c.test_error_and_loss(model)
+            c.release_data()
             tot_correct.append(ct * 1.0)
             num_samples.append(ns)
             losses.append(cl * 1.0)
-        ids = [c.user_id for c in self.users]
 
-        return ids, num_samples, tot_correct, losses
+        return ids, torch.tensor(num_samples), torch.tensor(tot_correct), torch.stack(losses).detach()
+
+    def train_error_and_loss(self, model):
+        """Excess error of the global model for the evaluated users (train data)"""
+        ids = [c.user_id for c in self.evaluated_users]
+        # groups = [c.group for c in self.evaluated_users]
+        if self.evaluator is not None:
+            num_samples, tot_correct, losses = self.evaluator.train_error_and_loss(model)
+            return ids, num_samples, tot_correct, losses, losses - self.get_losses_lowest()
 
-    def train_error_and_loss(self):
-        """Excess error of the current model of all users (train data)"""
         num_samples = []
         tot_correct = []
         losses = []
-        losses_diff = []
-        for c in self.users:
-            ct, cl, cl_lowest, ns = c.train_error_and_loss(self.model_lowest)
+        for c in self.evaluated_users:
+            ct, cl, ns = c.train_error_and_loss(model)
+            c.release_data()
             tot_correct.append(ct * 1.0)
             num_samples.append(ns)
             losses.append(cl * 1.0)
-            losses_diff.append((cl - cl_lowest) * 1.0)
-
-        ids = [c.user_id for c in self.users]
-        # groups = [c.group for c in self.users]
-
-        return ids, num_samples, tot_correct, losses, losses_diff
-
-    def train_dissimilarity(self):
-        """Gradient dissimilarity of the current model of all users (train data)"""
-        dissimilarities = []
-        for c in self.users:
-            dissimilarities.append(c.train_dissimilarity())
-        return dissimilarities
-
-    def evaluate(self):
-        """Saves the metrics at the beginning of each communication round."""
-        stats_test = self.test_error_and_loss()
-        stats_train = self.train_error_and_loss()
-        dissimilarity = self.train_dissimilarity()
+        losses = torch.stack(losses).detach()
+
+        return ids, torch.tensor(num_samples), torch.tensor(tot_correct), losses, losses - self.get_losses_lowest()
+
+    def get_losses_lowest(self):
+        """Train losses F_i(x*) of model_lowest for the evaluated users. They are computed once, since model_lowest does
+        not change during training, and persisted next to model_lowest if cache_lowest (keyed by number and fold)."""
+        if self.losses_lowest is not None:
+            return self.losses_lowest
+
+        ids = [c.user_id for c in self.evaluated_users]
+        k_fold = self.evaluated_users[0].data_store.k_fold
+        cache_path = self.model_lowest_path[:-len(".pt")] + "_losses_" + self.number
+        if k_fold is not None:
+            cache_path += "_fold" + str(k_fold)
+        cache_path += ".pt"
+
+        if self.cache_lowest and os.path.exists(cache_path) and \
+                os.path.getmtime(cache_path) >= os.path.getmtime(self.model_lowest_path):
+            cache = torch.load(cache_path, weights_only=True)  # user ids and tensor only
+            if cache["users"] == ids:
+                self.losses_lowest = cache["losses"].to(self.flat_state.device)
+                return self.losses_lowest
+
+        if self.evaluator is not None:
+            _, self.losses_lowest = self.evaluator.error_and_loss(self.model_lowest, self.evaluator.train)
+        else:
+            losses = []
+            for c in self.evaluated_users:
+                losses.append(c.train_error_and_loss(self.model_lowest)[1])
+                c.release_data()
+            self.losses_lowest = torch.stack(losses).detach()
+
+        if self.cache_lowest:
+            # temporary file renamed: never read partially written by the other processes of a sweep
+            tmp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+            torch.save({"users": ids, "losses": self.losses_lowest.cpu()}, tmp_path)
+            os.replace(tmp_path, cache_path)
+        return self.losses_lowest
+
+    def train_dissimilarity(self, model):
+        """Gradient dissimilarity of the global model for the evaluated users (train data): matrix of the gradients,
+        written in place (one row per user)"""
+        if self.dissimilarities is None:
+            self.dissimilarities = torch.zeros(len(self.evaluated_users), self.dim_model, device=self.flat_state.device)
+        if self.evaluator is not None:
+            return self.evaluator.train_dissimilarity(model, self.dissimilarities)
+
+        for c, gradient in zip(self.evaluated_users, self.dissimilarities):
+            c.train_dissimilarity(model, gradient)
+            c.release_data()
+        return self.dissimilarities
+
+    def select_evaluated_users(self):
+        """Selecting the users of the evaluation: all users, or a fixed random subset of nb_eval_users users (the
+        averages over the subset being unbiased estimates of the averages over all users, see evaluate)"""
+        if self.nb_eval_users in [len(self.users), 0]:
+            return self.users
 
-        train_diss_1 = sum([torch.norm(dis).cpu().numpy() ** 2 for dis in dissimilarity]) / len(self.users)
-        train_diss_2 = torch.norm(
-            sum([dis for dis in dissimilarity]) / len(self.users)).cpu().numpy() ** 2
+        assert 1 < self.nb_eval_users < len(self.users), "Nb of evaluated users not correct"
+        indices = np.random.RandomState(self.times).choice(len(self.users), self.nb_eval_users, replace=False)
+        return [self.users[i] for i in sorted(indices)]
+
+    def evaluate(self, glob_iter, force=False):
+        """Saves the metrics at the beginning of the communication round glob_iter (if in eval_rounds or force).
+        If async_eval, a snapshot of the global model is evaluated in a background thread during the local updates of
+        the round (one evaluation at a time, so that the metrics are saved in round order, see wait_evaluation)."""
+        if glob_iter not in self.eval_rounds and not force:
+            return
+        epsilon = None if self.ledger is None else self.ledger.epsilon()
+        if self.evaluated_users is None:
+            self.evaluated_users = self.select_evaluated_users()
+        # all users evaluated at once, unless their data is paged in only when needed
+        if self.evaluator is None and not self.users[0].data_store.lazy:
+            self.evaluator = FederationEvaluator(self.evaluated_users)
+
+        if self.eval_pool is None:
+            self.evaluate_model(glob_iter, self.model, epsilon)
+            return
+
+        self.wait_evaluation()
+        if self.eval_model is None:
+            self.eval_model = copy.deepcopy(self.model)
+            for param in self.eval_model.parameters():
+                param.data = param.data.clone()
+            self.flat_eval = flat_buffer(list(self.eval_model.parameters()))
+        self.flat_eval.copy_(self.flat_state[:self.flat_eval.numel()])  # the model comes first in the global state
+        self.eval_future = self.eval_pool.submit(self.evaluate_model, glob_iter, self.eval_model, epsilon)
+
+    def spend_privacy(self, glob_iter):
+        """Spends the DP epsilon of the round glob_iter for the selected users (see PrivacyLedger). Returns False if
+        the round would exceed the budget: training stops, the global model being evaluated a last time."""
+        if self.ledger is None:
+            return True
+        if not self.ledger.allows(len(self.selected_users)):
+            print(f"DP budget epsilon={self.epsilon_budget} exhausted after {glob_iter} rounds")
+            if glob_iter not in self.eval_rounds:
+                self.evaluate(glob_iter, force=True)
+            return False
+        self.ledger.spend(len(self.selected_users))
+        return True
+
+    def wait_evaluation(self):
+        """Waits for the background evaluation (see evaluate)."""
+        if self.eval_future is not None:
+            self.eval_future.result()
+            self.eval_future = None
+
+    def evaluate_model(self, glob_iter, model, epsilon=None):
+        """Saves the metrics of model (global model at the beginning of the communication round glob_iter), with the
+        DP epsilon spent before the round (if DP)."""
+        stats_test = self.test_error_and_loss(model)
+        stats_train = self.train_error_and_loss(model)
+        dissimilarity = self.train_dissimilarity(model)
+        nb_users = len(self.evaluated_users)
+
+        # mean of the squared norms and squared norm of the mean of the gradients
+        sum_norms = float(torch.linalg.vector_norm(dissimilarity)) ** 2
+        norm_mean = float(torch.linalg.vector_norm(torch.mean(dissimilarity, dim=0))) ** 2
+        train_diss_1 = sum_norms / nb_users
+        train_diss_2 = norm_mean
+        if nb_users < len(self.users):
+            # unbiased estimate of the squared norm of the mean gradient (sampling without replacement)
+            variance = (sum_norms - nb_users * norm_mean) / (nb_users - 1)
+            train_diss_2 -= (1 - nb_users / len(self.users)) * variance / nb_users
 
         train_diss = train_diss_1 - train_diss_2
 
-        glob_acc = np.sum(stats_test[2]) * 1.0 / np.sum(stats_test[1])
-        train_acc = np.sum(stats_train[2]) * 1.0 / np.sum(stats_train[1])
+        glob_acc = float(torch.sum(stats_test[2])) / float(torch.sum(stats_test[1]))
+        train_acc = float(torch.sum(stats_train[2])) / float(torch.sum(stats_train[1]))
 
-        train_loss_diff = sum([x.item() for x in stats_train[4]]) / len(self.users)
-        train_loss = sum([x.item() for x in stats_train[3]]) / len(self.users)
+        train_loss_diff = float(torch.sum(stats_train[4])) / nb_users
+        train_loss = float(torch.sum(stats_train[3])) / nb_users
 
-        test_loss = sum([x.item() for x in stats_test[3]]) / len(self.users)
+        test_loss = float(torch.sum(stats_test[3])) / nb_users
 
-        self.rs_glob_acc.append(glob_acc)
-        self.rs_test_loss.append(test_loss)
-        self.rs_train_acc.append(train_acc)
         if self.dp == "None" and self.similarity == "iid":
-            self.rs_train_loss.append(train_loss)
+            rs_train_loss = train_loss
         else:
-            self.rs_train_loss.append(train_loss_diff)
-        self.rs_train_diss.append(train_diss)
+            rs_train_loss = train_loss_diff
+        metrics = dict(rs_rounds=glob_iter, rs_glob_acc=glob_acc, rs_test_loss=test_loss, rs_train_acc=train_acc,
+                       rs_train_loss=rs_train_loss, rs_train_diss=train_diss)
+        if epsilon is not None:
+            metrics["rs_epsilon"] = epsilon
+        self.results.append(**metrics)
 
         print("Similarity:", self.similarity)
         print("Average Global Test Accuracy: ", round(glob_acc, 5))
@@ -218,3 +447,5 @@ class Server:
         print("Average Global Training Gradient Dissimilarity: ", round(train_diss, 5))
         print("Average Global Training Gradient Dissimilarity (mean of norms): ", round(train_diss_1, 5))
         print("Average Global Training Gradient Dissimilarity (norm of mean): ", round(train_diss_2, 5))
+        if epsilon is not None:
+            print("DP epsilon spent: ", round(epsilon, 5))
@@ -3,7 +3,9 @@ import os
 import h5py
 from flearn.users.user_scaffold import UserSCAFFOLD
 from flearn.servers.server_base import Server
-from utils.model_utils import read_data, read_user_data, read_data_cross_validation
+from flearn.servers.executor import get_executor
+from flearn.users.user_batch import train_batched
+from utils.model_utils import UserDataStore, flat_buffer
 from scipy.stats import rayleigh
 import numpy as np
 
@@ -13,7 +15,9 @@ class SCAFFOLD(Server):
     def __init__(self, dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L,
                  local_learning_rate, max_norm, num_glob_iters, local_updates, users_per_round, similarity, noise,
                  times, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda, warm_start, k_fold=None,
-                 nb_fold=None):
+                 nb_fold=None, lazy_data=False, executor="serial",
+                 cache_lowest=False, eval_every=1, eval_growth=1., eval_users=0, async_eval=False,
+                 checkpoint_every=0, resume=False, epsilon_budget=0.):
 
         if similarity is None:
             similarity = (alpha, beta)
@@ -23,8 +27,8 @@ class SCAFFOLD(Server):
 
         super().__init__(dataset, algorithm, model[0], nb_users, nb_samples, user_ratio, sample_ratio, L, max_norm,
                          num_glob_iters, local_updates, users_per_round, similarity, noise, times, dp, sigma_gaussian,
-                         number, model[1], use_cuda)
-        self.control_norms = []
+                         number, model[1], use_cuda, cache_lowest, eval_every, eval_growth,
+                         eval_users, async_eval, checkpoint_every, resume, epsilon_budget)
         self.warm_start = warm_start
 
         local_epochs = max(round(self.local_updates * sample_ratio),1)
@@ -35,18 +39,13 @@ class SCAFFOLD(Server):
         if model[1][-3:] != "PCA":
             dim_pca = None
 
-        # Initialize data for all  users
-        if k_fold is None:
-            data = read_data(dataset, self.number, str(self.similarity), dim_pca)
-        else:
-            # Cross Validation
-            data = read_data_cross_validation(dataset, self.number, str(self.similarity), k_fold, nb_fold, dim_pca)
+        # Initialize data for all users (cross validation if k_fold is not None)
+        self.data_store = UserDataStore(dataset, self.number, str(self.similarity), dim_pca, k_fold, nb_fold,
+                                        lazy=lazy_data)
 
-        total_users = len(data[0])
+        total_users = len(self.data_store)
         for i in range(total_users):
-            id, train, test = read_user_data(i, data, dataset)
-
-            user = UserSCAFFOLD(id, train, test, model, sample_ratio, self.local_learning_rate, L,
+            user = UserSCAFFOLD(i, self.data_store, model, sample_ratio, self.local_learning_rate, L,
                                 local_updates, dp, times, use_cuda)
             self.users.append(user)
             self.total_train_samples += user.train_samples
@@ -57,25 +56,27 @@ class SCAFFOLD(Server):
         print("Number of users / total users:", users_per_round, " / ", total_users)
 
         self.server_controls = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
+        self.flat_state = flat_buffer(self.global_state())  # model and controls as views of a flat vector
         self.seen_users_controls = []
 
+        # execution of the local updates (see flearn.servers.executor)
+        self.executor = get_executor(executor, self)
+
         print("Finished creating SCAFFOLD server.")
 
     def train(self):
         loss = []
-        for glob_iter in range(self.num_glob_iters):
+        self.open_results()
+        for glob_iter in range(self.load_checkpoint(), self.num_glob_iters):
             print("-------------Round number: ", glob_iter, " -------------")
             # loss_ = 0
 
-            # Each user gets the global parameters and sets their controls
-            self.send_parameters(glob_iter)
-
             # WARM START : wise initialisation depending on x_0
             if self.warm_start and glob_iter == 0:
                 self.set_controls_all_users()
 
-            # Evaluate model at each iteration
-            self.evaluate()
+            # Evaluate model (see eval_rounds)
+            self.evaluate(glob_iter)
 
             # Users are selected
             if self.noise:
@@ -84,20 +85,14 @@ class SCAFFOLD(Server):
             else:
                 self.selected_users = self.select_users(glob_iter, self.users_per_round)
 
-            # Local updates
-            for user in self.selected_users:
-
-                seen = (user.user_id in self.seen_users_controls)
-
-                if self.dp == "None":
-                    user.train_no_dp(glob_iter, self.user_ratio, self.warm_start, seen)
-                else:
-                    user.train_dp(self.sigma_g, glob_iter, self.user_ratio, self.max_norm,
-                                  self.warm_start, seen)
-
-                self.seen_users_controls.append(user.user_id)
+            # DP epsilon of the round (training stopped if the budget is exhausted)
+            if not self.spend_privacy(glob_iter):
+                break
 
-                user.drop_lr()
+            # Local updates
+            seen = [user.user_id in self.seen_users_controls for user in self.selected_users]
+            self.executor.run(self.selected_users, glob_iter, seen)
+            self.seen_users_controls.extend([user.user_id for user in self.selected_users])
 
             # Aggregation
 
@@ -107,26 +102,71 @@ class SCAFFOLD(Server):
             if self.noise:
                 self.apply_channel_effect()
 
+            self.save_checkpoint(glob_iter + 1)
+
+        self.executor.close()
+        self.wait_evaluation()
         self.save_results()
         self.save_norms()
         self.save_model()
+        self.remove_checkpoint()
+
+    def get_checkpoint(self):
+        checkpoint = super().get_checkpoint()
+        checkpoint["seen_users_controls"] = list(self.seen_users_controls)
+        return checkpoint
+
+    def set_checkpoint(self, checkpoint):
+        super().set_checkpoint(checkpoint)
+        self.seen_users_controls = list(checkpoint["seen_users_controls"])
+
+    def local_update(self, user, glob_iter, seen):
+        """Local updates of user (seen: True if the controls of user have already been sent to the server)."""
+        with self.worker_model(user, glob_iter):
+            if self.dp == "None":
+                user.train_no_dp(glob_iter, self.user_ratio, self.warm_start, seen)
+            else:
+                user.train_dp(self.sigma_g, glob_iter, self.user_ratio, self.max_norm, self.warm_start, seen)
+        user.drop_lr()
+        user.release_data()
+
+    def batched_local_update(self, users, glob_iter, seen):
+        """Local updates of users at once (see flearn.users.user_batch)."""
+        for user in users:
+            self.send_user_parameters(user, glob_iter)
+        # no training during warm start strategy
+        if (not self.warm_start) or glob_iter >= round(4 / self.user_ratio):
+            train_batched(users, self.model, glob_iter, None if self.dp == "None" else self.sigma_g, scaffold=True)
+        else:
+            for user in users:
+                for delta in user.delta_model:
+                    delta.data.zero_()
+        for user, user_seen in zip(users, seen):
+            user.update_controls(glob_iter, self.user_ratio, self.warm_start, user_seen)
+            user.drop_lr()
+            user.release_data()
+
+    def send_user_parameters(self, user, glob_iter=None):
+        """User setting its parameters and controls from the server."""
+        user.set_parameters(self.model)
+
+        # for the first 4/self.user_ratio rounds : warm start-strategy on c_i (c remains zero for users)
+        if (not self.warm_start) or glob_iter >= round(4 / self.user_ratio):
+            user.server_controls = self.server_controls
+        else:
+            user.server_controls = [torch.zeros_like(control) for control in self.server_controls]
 
-    def send_parameters(self, glob_iter):
-        """Users setting their parameters and controls from the server."""
-        assert (self.users is not None and len(self.users) > 0)
-        for user in self.users:
-            user.set_parameters(self.model)
-
-            # for the first 4/self.user_ratio rounds : warm start-strategy on c_i (c remains zero for users)
-            if (not self.warm_start) or glob_iter >= round(4 / self.user_ratio):
-                for control, new_control in zip(user.server_controls, self.server_controls):
-                    control.data = new_control.data
+    def global_state(self):
+        """Tensors of the server sent to the users at every round: model and controls."""
+        return list(self.model.parameters()) + self.server_controls
 
     def set_controls_all_users(self):
         """Setting the initial control variables for all users."""
         assert (self.users is not None and len(self.users) > 0)
         for user in self.users:
-            self.set_controls(user)
+            with self.worker_model(user, 0):
+                self.set_controls(user)
+            user.release_data()
             print("C_io done :", user.user_id)
 
     def set_controls(self, user):
@@ -147,15 +187,14 @@ class SCAFFOLD(Server):
 
     def add_parameters(self, user, ratio):
         """Adding to the server model the contribution term from user."""
-        # num_of_selected_users = len(self.selected_users)
         num_of_users = len(self.users)
-        for param, control, del_control, del_model in zip(self.model.parameters(), self.server_controls,
-                                                          user.delta_controls, user.delta_model):
-            param.data = param.data + self.global_learning_rate * del_model.data * ratio
-            control.data = control.data + del_control.data / num_of_users
+        params, controls = self.flat_state.chunk(2)
+        del_model, del_controls = user.flat_deltas.chunk(2)
+        params.add_(del_model, alpha=self.global_learning_rate * ratio)
+        controls.add_(del_controls, alpha=1 / num_of_users)
 
-            # below : same sample size for all users
-            # param.data = param.data + self.global_learning_rate * del_model.data / num_of_selected_users
+        # below : same sample size for all users
+        # params.add_(del_model, alpha=self.global_learning_rate / len(self.selected_users))
 
     def get_max_norm(self):
         """Getting the maximum ||x_user^t+1 -x_server^t|| & ||c_user^t+1 -c_server^t|| over the users"""
@@ -165,17 +204,15 @@ class SCAFFOLD(Server):
             param_norm, control_norm = user.get_params_norm()
             param_norms.append(param_norm)
             control_norms.append(control_norm)
-        self.param_norms.append(max(param_norms))
-        self.control_norms.append((max(control_norms)))
+        self.param_norm, self.control_norm = max(param_norms), max(control_norms)
+        self.norms.append(rs_param_norms=self.param_norm, rs_control_norms=self.control_norm)
 
     def apply_channel_effect(self, sigma=1, power_control=2500):
         num_of_selected_users = len(self.selected_users)
-        alpha_t_params = power_control / self.param_norms[-1] ** 2
-        alpha_t_controls = 4e4 * power_control / self.control_norms[-1] ** 2
-        for param, control in zip(self.model.parameters(), self.server_controls):
-            param.data = param.data + sigma / (
-                    alpha_t_params ** 0.5 * num_of_selected_users * self.communication_thresh) * torch.randn(
-                param.data.size())
-            control.data = control.data + sigma / (
-                    alpha_t_controls ** 0.5 * num_of_selected_users * self.communication_thresh) * torch.randn(
-                control.data.size())
+        alpha_t_params = power_control / self.param_norm ** 2
+        alpha_t_controls = 4e4 * power_control / self.control_norm ** 2
+        params, controls = self.flat_state.chunk(2)
+        params.add_(torch.randn(params.size(), device=params.device),
+                    alpha=sigma / (alpha_t_params ** 0.5 * num_of_selected_users * self.communication_thresh))
+        controls.add_(torch.randn(controls.size(), device=controls.device),
+                      alpha=sigma / (alpha_t_controls ** 0.5 * num_of_selected_users * self.communication_thresh))
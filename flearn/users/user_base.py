@@ -4,26 +4,29 @@ import torch.nn.functional as F
 import os
 import json
 from torch.utils.data import DataLoader
-from torch.utils.data import SubsetRandomSampler
+from torch.utils.data import SubsetRandomSampler, SequentialSampler, BatchSampler
 import numpy as np
 import copy
+from flearn.differential_privacy.differential_privacy import GaussianMechanism
+from utils.model_utils import flat_buffer
 
 
 # Super class for the user settings (either FedAvg/FedSGD or SCAFFOLD)
 
 class User:
 
-    def __init__(self, user_id, train_data, test_data, model, sample_ratio, learning_rate, L, local_updates,
-                 dp, times, use_cuda):
+    def __init__(self, user_index, data_store, model, sample_ratio, learning_rate, L, local_updates, dp, times,
+                 use_cuda):
         self.use_cuda = use_cuda
 
         self.optimizer = None
-        self.model = copy.deepcopy(model)
-        if use_cuda:
-            self.model = self.model.cuda()
-        self.user_id = user_id  # integer
-        self.train_samples = len(train_data)
-        self.test_samples = len(test_data)
+        self.model = None  # worker model, only bound for the local updates (see bind_model)
+        self.device = torch.device("cuda" if use_cuda else "cpu")
+        self.user_index = user_index  # integer
+        self.user_id = data_store.users[user_index]
+        self.data_store = data_store
+        self.train_samples = data_store.train_size(user_index)
+        self.test_samples = data_store.test_size(user_index)
         self.sample_ratio = sample_ratio
         self.batch_size = round(sample_ratio * self.train_samples)
         self.learning_rate = learning_rate
@@ -31,47 +34,152 @@ class User:
         self.local_updates = local_updates
         self.scheduler = None
         self.lr_drop_rate = 1
-        self.train_data = train_data
         self.times = times
 
-        # for data loader
-        np.random.seed(0)
-        torch.manual_seed(0)
-        train_idx = np.arange(self.train_samples)
-        train_sampler = SubsetRandomSampler(train_idx)
-        self.trainloader = DataLoader(train_data, self.batch_size, sampler=train_sampler)
-
-        self.testloader = DataLoader(test_data, self.batch_size)
-        self.testloaderfull = DataLoader(test_data, self.test_samples)
-        self.trainloaderfull = DataLoader(train_data, self.train_samples)
-        self.iter_trainloader = iter(self.trainloader)
-        self.iter_testloader = iter(self.testloader)
+        # data paged in from data_store when needed (see load_data)
+        self._train_data = None
+        self._test_data = None
+        self.trainloader = None
+        self.iter_trainloader = None
+        self.iter_testloader = None
+        self.generator = torch.Generator()  # for batch sampling
 
         self.dp = dp
+        self.dp_mechanism = None
 
-        self.delta_model = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
-        self.server_model = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
+        self.delta_model = [torch.zeros_like(p.data, device=self.device) for p in model.parameters()
+                            if p.requires_grad]
+        self.flat_deltas = flat_buffer(self.delta_model)  # delta_model as views of a flat vector
+        self.server_model = None  # parameters of the global model (see set_parameters)
 
-        # those parameters are for FEDL.
-        self.local_model = copy.deepcopy(list(self.model.parameters()))
-        self.server_grad = copy.deepcopy(list(self.model.parameters()))
+    def load_data(self):
+        """Creates the tensors of the user from the data store (and returns them)."""
+        _, train_data, test_data = self.data_store.read_user_data(self.user_index)
+        self.set_data(train_data, test_data)
+        return train_data, test_data
 
-    def set_parameters(self, server_model):
-        for old_param, new_param, local_param, server_param in zip(self.model.parameters(), server_model.parameters(),
-                                                                   self.local_model, self.server_model):
-            old_param.data = new_param.data.clone()
-            local_param.data = new_param.data.clone()
-            server_param.data = new_param.data.clone()
-            if (new_param.grad != None):
-                if (old_param.grad == None):
-                    old_param.grad = torch.zeros_like(new_param.grad)
+    def set_data(self, train_data, test_data):
+        """Sets the data of the user (TensorDatasets)."""
+        self._train_data = train_data
+        self._test_data = test_data
+        train_sampler = SubsetRandomSampler(np.arange(self.train_samples))
+        self.trainloader = self.get_loader(self._train_data, self.batch_size, train_sampler)
+        self.iter_trainloader = None
+        self.iter_testloader = None
+
+    def release_data(self):
+        """Drops the tensors of the user if the data store is lazy (they are paged in again at the next use)."""
+        if self.data_store.lazy:
+            self._train_data = None
+            self._test_data = None
+            self.trainloader = None
+            self.iter_trainloader = None
+            self.iter_testloader = None
+
+    # the tensors are returned as loaded, since they can be released by another thread (see Server.evaluate)
+    @property
+    def train_data(self):
+        train_data = self._train_data
+        if train_data is None:
+            train_data, _ = self.load_data()
+        return train_data
+
+    @property
+    def test_data(self):
+        test_data = self._test_data
+        if test_data is None:
+            _, test_data = self.load_data()
+        return test_data
+
+    @property
+    def testloader(self):
+        return self.get_loader(self.test_data, self.batch_size)
+
+    @property
+    def testloaderfull(self):
+        return self.get_loader(self.test_data, self.test_samples)
+
+    @property
+    def trainloaderfull(self):
+        return self.get_loader(self.train_data, self.train_samples)
+
+    def get_batch(self, seed):
+        """Returns a batch of batch_size train samples drawn without replacement, seeded by seed.
+
+        The batch is the first one of a DataLoader with SubsetRandomSampler after torch.manual_seed(seed) (as in the
+        previous versions of the code), but only this batch is gathered."""
+        self.generator.manual_seed(seed)
+        # draw of the base seed of the DataLoader iterator
+        torch.empty((), dtype=torch.int64).random_(generator=self.generator)
+        indices = torch.randperm(self.train_samples, generator=self.generator)[:self.batch_size]
+        X, y = self.train_data[indices]
+        if self.use_cuda:
+            X, y = X.cuda(), y.cuda()
+        return X, y
+
+    def bind_model(self, model, dp_mechanism=None):
+        """Binds a worker model to the user (see Server.worker_model), its optimizer acting on it.
+        :param dp_mechanism : GaussianMechanism of model, reused by the user (if None, created at the first DP step)"""
+        self.model = model
+        self.dp_mechanism = dp_mechanism
+        for group, p in zip(self.optimizer.param_groups, model.parameters()):
+            group['params'] = [p]
+
+    def release_model(self):
+        """Unbinds the worker model and its DP mechanism (the user only keeps its data and its persistent state)."""
+        self.model = None
+        self.dp_mechanism = None
+
+    def get_dp_mechanism(self, sigma_g):
+        """DP mechanism of the worker model (buffers allocated once per worker model), set for the user"""
+        if self.dp_mechanism is None:
+            self.dp_mechanism = GaussianMechanism(self.model, sigma_g, self.batch_size)
+        self.dp_mechanism.sigma_g = sigma_g
+        self.dp_mechanism.batch_size = self.batch_size
+        return self.dp_mechanism
 
-                if (local_param.grad == None):
-                    local_param.grad = torch.zeros_like(new_param.grad)
+    def get_noise_seed(self):
+        """Seed of the Gaussian noise, drawn from the generator of the last batch."""
+        return int(torch.randint(2 ** 62, (), generator=self.generator))
 
-                old_param.grad.data = new_param.grad.data.clone()
-                local_param.grad.data = new_param.grad.data.clone()
-        # self.local_weight_updated = copy.deepcopy(self.optimizer.param_groups[0]['params'])
+    def dp_step(self, sigma_g):
+        """DP mechanism on the per-sample gradients of the model (clipping with the median heuristic, otherwise use
+        max_norm constant, and Gaussian noise), the noise being seeded from the generator of the last batch."""
+        self.get_dp_mechanism(sigma_g).step(self.get_noise_seed())
+
+    def get_state(self):
+        """Persistent state of the user over the rounds (see Server.save_checkpoint)."""
+        return {'lr': [group['lr'] for group in self.optimizer.param_groups]}
+
+    def set_state(self, state):
+        for group, lr in zip(self.optimizer.param_groups, state['lr']):
+            group['lr'] = lr
+
+    def get_deltas(self):
+        """Tensors sent to the server after the local updates (views of self.flat_deltas)."""
+        return self.delta_model
+
+    def update_delta_model(self):
+        """Model difference x_user^t+1 - x_server^t after the local updates (in place, see self.flat_deltas)."""
+        for local, server, delta in zip(self.model.parameters(), self.server_model, self.delta_model):
+            delta.data.copy_(local.data.detach() - server.data.detach())
+
+    @staticmethod
+    def get_loader(dataset, batch_size, sampler=None):
+        """Data loader over a TensorDataset, each batch being gathered at once by indexing its tensors
+        (no collation of single samples)."""
+        if sampler is None:
+            sampler = SequentialSampler(dataset)
+        return DataLoader(dataset, batch_size=None, sampler=BatchSampler(sampler, batch_size, drop_last=False))
+
+    def set_parameters(self, server_model):
+        """Loads the global model into the worker model of the user (if bound), the global parameters being kept
+        (not copied) as reference of the model difference."""
+        self.server_model = list(server_model.parameters())
+        if self.model is not None:
+            for param, server_param in zip(self.model.parameters(), self.server_model):
+                param.data.copy_(server_param.data)
+                param.grad = None
 
     def set_new_parameters(self, new_parameters):
         for old_param, new_param in zip(self.model.parameters(), new_parameters):
@@ -114,57 +222,57 @@ class User:
         #    grad.grad.data = param.grad.data.clone()
         return grads
 
-    def test_error_and_loss(self):
-        """Returns metrics evaluated on test data."""
-        self.model.eval()
+    def test_error_and_loss(self, model):
+        """Returns metrics of model evaluated on test data."""
+        model.eval()
         test_acc = 0
         loss = 0
         for x, y in self.testloaderfull:
             if self.use_cuda:
                 x, y = x.cuda(), y.cuda()
-            output = self.model(x)
+            output = model(x)
             test_acc += (torch.sum(torch.argmax(output, dim=1) == y)).item()
             loss += self.loss(output, y)
             # print(self.user_id + ", Test Loss:", loss)
         return test_acc, loss, y.shape[0]
 
-    def train_error_and_loss(self, model_lowest):
-        """Returns metrics evaluated on train data."""
-        self.model.eval()
-        model_lowest.eval()
+    def train_error_and_loss(self, model):
+        """Returns metrics of model evaluated on train data."""
+        model.eval()
         train_acc = 0
         loss = 0
-        loss_lowest = 0
         for x, y in self.trainloaderfull:
             if self.use_cuda:
                 x, y = x.cuda(), y.cuda()
-            output_lowest = model_lowest(x)
-            loss_lowest += self.loss(output_lowest, y)
-
-            output = self.model(x)
+            output = model(x)
             train_acc += (torch.sum(torch.argmax(output, dim=1) == y)).item()
             loss += self.loss(output, y)
             # print(self.user_id + ", Train Accuracy:", train_acc)
             # print(self.user_id + ", Train Loss:", loss)
-        return train_acc, loss, loss_lowest, self.train_samples
+        return train_acc, loss, self.train_samples
 
-    def train_dissimilarity(self):
-        """Returns gradients for gradient dissimilarity."""
-        self.model.eval()
-        gradients = [torch.flatten(torch.zeros_like(p.data)) for p in self.model.parameters()]
+    def train_dissimilarity(self, model, gradient):
+        """Writes the gradient of model on train data (flattened) into gradient, for gradient dissimilarity."""
+        model.eval()
+        gradient.zero_()
         for x, y in self.trainloaderfull:
             if self.use_cuda:
                 x, y = x.cuda(), y.cuda()
-            self.optimizer.zero_grad()
-            output = self.model(x)
+            model.zero_grad()
+            output = model(x)
             loss = self.loss(output, y)
             loss.backward()
-            for p, gradient in zip(self.model.parameters(), gradients):
-                gradient += torch.flatten(copy.deepcopy(p.grad.data))
-
-        return torch.cat(gradients)
+            offset = 0
+            for p in model.parameters():
+                gradient[offset:offset + p.numel()] += p.grad.view(-1)
+                offset += p.numel()
+        return gradient
 
     def get_next_train_batch(self):
+        if self.iter_trainloader is None:
+            if self._train_data is None:
+                self.load_data()
+            self.iter_trainloader = iter(self.trainloader)
         try:
             # Samples a new batch for personalizing
             (X, y) = next(self.iter_trainloader)
@@ -175,6 +283,8 @@ class User:
         return (X, y)
 
     def get_next_test_batch(self):
+        if self.iter_testloader is None:
+            self.iter_testloader = iter(self.testloader)
         try:
             # Samples a new batch for personalizing
             (X, y) = next(self.iter_testloader)
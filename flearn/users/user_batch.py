@@ -0,0 +1,88 @@
+import torch
+from torch.func import functional_call, vmap, grad
+from flearn.differential_privacy.differential_privacy import GaussianMechanism, clipping_factors
+from utils.autograd_hacks import disable_hooks, enable_hooks
+
+
+# Local updates of several users at once (vmap over users)
+
+def can_train_batched(users):
+    """Users can be trained at once if their batches have the same size."""
+    return len(users) > 0 and len({(user.batch_size, user.local_updates) for user in users}) == 1
+
+
+def train_batched(users, model, glob_iter, sigma_g=None, scaffold=False):
+    """ Runs the local updates of users (see UserAVG.train_no_dp/train_dp and UserSCAFFOLD.train_no_dp/train_dp) at
+    once: the parameters of the users are stacked along a first dimension and every local step is a single vmapped
+    forward/backward pass. The model differences of the users are set (controls are then updated by the users).
+    :param users : users checked by can_train_batched
+    :param model : global model (initial parameters of every user)
+    :param glob_iter : round number (seeds of the batches)
+    :param sigma_g : if not None, DP mechanism on the per-sample gradients (same clipping and noise as User.dp_step)
+    :param scaffold : if True, local steps corrected by the controls (see SCAFFOLDOptimizer)"""
+    loss_function = users[0].loss
+    names = [name for name, _ in model.named_parameters()]
+    params = {name: p.data.expand(len(users), *p.shape).clone() for name, p in model.named_parameters()}
+    lrs = torch.tensor([user.optimizer.param_groups[0]['lr'] for user in users], device=params[names[0]].device)
+    if scaffold:
+        server_controls = [torch.stack(controls) for controls in zip(*[user.server_controls for user in users])]
+        controls = [torch.stack(controls) for controls in zip(*[user.controls for user in users])]
+
+    def compute_loss(user_params, X, y):
+        return loss_function(functional_call(model, user_params, (X,)), y)
+
+    if sigma_g is None:
+        compute_grads = vmap(grad(compute_loss))
+    else:
+        mechanism = GaussianMechanism(model, sigma_g, users[0].batch_size)
+
+        # per-sample gradients (loss of a batch of one sample)
+        def compute_sample_loss(user_params, x, y):
+            return compute_loss(user_params, x.unsqueeze(0), y.unsqueeze(0))
+
+        compute_grads = vmap(vmap(grad(compute_sample_loss), in_dims=(None, 0, 0)))
+
+    model.train()
+    disable_hooks()
+    try:
+        for epoch in range(1, users[0].local_updates + 1):
+            # new batches (data sampling on every local epoch)
+            batches = [user.get_batch(500 * (user.times + 1) * (glob_iter + 1) + epoch + 1) for user in users]
+            X = torch.stack([X for X, _ in batches])
+            y = torch.stack([y for _, y in batches])
+
+            grads = compute_grads(params, X, y)
+            if sigma_g is not None:
+                grads = dp_grads(users, mechanism, names, grads)
+
+            for i, name in enumerate(names):
+                if scaffold:
+                    d_p = grads[name] + server_controls[i] - controls[i]
+                else:
+                    d_p = grads[name]
+                params[name] = params[name] - d_p * lrs.view(-1, *[1] * (d_p.dim() - 1))
+    finally:
+        enable_hooks()
+
+    # get model differences
+    for j, user in enumerate(users):
+        for name, server_param, delta in zip(names, model.parameters(), user.delta_model):
+            delta.data.copy_(params[name][j] - server_param.data)
+
+
+def dp_grads(users, mechanism, names, sample_grads):
+    """Noisy averages of the clipped per-sample gradients of each user, computed by mechanism (same clipping and same
+    noise as User.dp_step).
+    :param mechanism : GaussianMechanism of the global model
+    :param sample_grads : per-sample gradients (nb of users, batch_size, *shape of the parameter) of each parameter"""
+    user_grads = []
+    for j, user in enumerate(users):
+        norms = torch.stack([sample_grads[name][j].flatten(1).norm(2, dim=1) for name in names])
+        factors, max_norms = clipping_factors(norms, mechanism.max_norm, mechanism.flat)
+        for name, grad, factor in zip(names, mechanism.grads, factors):
+            torch.mv(sample_grads[name][j].flatten(1).t(), factor, out=grad)
+        mechanism.add_noise(user.get_noise_seed(), max_norms)
+        user_grads.append([grad.clone() for grad in mechanism.grads])
+
+    return {name: torch.stack(grads).view_as(sample_grads[name][:, 0]) for name, grads in
+            zip(names, zip(*user_grads))}
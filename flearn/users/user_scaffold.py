@@ -7,6 +7,7 @@ import json
 from torch.utils.data import DataLoader
 from torch.utils.data import SubsetRandomSampler
 from flearn.users.user_base import User
+from utils.model_utils import flat_buffer
 from flearn.optimizers.fedoptimizer import *
 from flearn.differential_privacy.differential_privacy import *
 import math
@@ -18,10 +19,10 @@ from utils.autograd_hacks import *
 # Implementation for SCAFFOLD users
 
 class UserSCAFFOLD(User):
-    def __init__(self, numeric_id, train_data, test_data, model, sample_ratio, learning_rate, L, local_updates,
-                 dp, times, use_cuda):
-        super().__init__(numeric_id, train_data, test_data, model[0], sample_ratio, learning_rate, L,
-                         local_updates, dp, times, use_cuda)
+    def __init__(self, numeric_id, data_store, model, sample_ratio, learning_rate, L, local_updates, dp, times,
+                 use_cuda):
+        super().__init__(numeric_id, data_store, model[0], sample_ratio, learning_rate, L, local_updates, dp, times,
+                         use_cuda)
 
         if model[1] == 'mclr':
             self.loss = nn.NLLLoss()
@@ -30,12 +31,15 @@ class UserSCAFFOLD(User):
             # self.scheduler = StepLR(self.optimizer, step_size=50, gamma=0.1)
             # self.lr_drop_rate = 0.95
 
-        param_groups = [{'params': p, 'lr': self.learning_rate} for p in self.model.parameters()]
+        # optimizer acting on the worker model bound to the user (see User.bind_model)
+        param_groups = [{'params': p, 'lr': self.learning_rate} for p in model[0].parameters()]
         self.optimizer = SCAFFOLDOptimizer(param_groups, lr=self.learning_rate, weight_decay=L)
 
-        self.controls = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
-        self.server_controls = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
-        self.delta_controls = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
+        self.controls = [torch.zeros_like(p.data, device=self.device) for p in model[0].parameters() if p.requires_grad]
+        self.server_controls = None  # controls of the server (see SCAFFOLD.send_user_parameters)
+        self.delta_controls = [torch.zeros_like(p.data, device=self.device) for p in model[0].parameters()
+                               if p.requires_grad]
+        self.flat_deltas = flat_buffer(self.get_deltas())  # delta_model and delta_controls as views of a flat vector
         self.csi = None
 
     def set_grads(self, new_grads):
@@ -55,16 +59,7 @@ class UserSCAFFOLD(User):
             self.optimizer.zero_grad()
 
             # new batch (data sampling on every local epoch)
-            np.random.seed(500 * (self.times + 1) + epoch + 1)
-            torch.manual_seed(500 * (self.times + 1) + epoch + 1)
-            train_idx = np.arange(self.train_samples)
-            train_sampler = SubsetRandomSampler(train_idx)
-            self.trainloader = DataLoader(self.train_data, self.batch_size, sampler=train_sampler)
-
-            X, y = list(self.trainloader)[0]
-
-            if self.use_cuda:
-                X, y = X.cuda(), y.cuda()
+            X, y = self.get_batch(500 * (self.times + 1) + epoch + 1)
 
             self.optimizer.zero_grad()
             clear_backprops(self.model)
@@ -89,35 +84,16 @@ class UserSCAFFOLD(User):
             self.optimizer.zero_grad()
 
             # new batch (data sampling on every local epoch)
-            np.random.seed(500 * (self.times + 1) + epoch + 1)
-            torch.manual_seed(500 * (self.times + 1) + epoch + 1)
-            train_idx = np.arange(self.train_samples)
-            train_sampler = SubsetRandomSampler(train_idx)
-            self.trainloader = DataLoader(self.train_data, self.batch_size, sampler=train_sampler)
-
-            X, y = list(self.trainloader)[0]
-
-            if self.use_cuda:
-                X, y = X.cuda(), y.cuda()
+            X, y = self.get_batch(500 * (self.times + 1) + epoch + 1)
 
             self.optimizer.zero_grad()
             clear_backprops(self.model)
             output = self.model(X)
             loss = self.loss(output, y)
             loss.backward(retain_graph=True)
-            compute_grad1(self.model)
-
-            for p in self.model.parameters():
-                # clipping single gradients
 
-                # heuristic: otherwise, use max_norm constant
-                max_norm = np.median([float(grad.data.norm(2)) for grad in p.grad1])
-
-                p.grad1 = torch.stack(
-                    [grad / max(1, float(grad.data.norm(2)) / max_norm) for grad in p.grad1])
-                p.grad.data = torch.mean(p.grad1, dim=0)
-                # DP mechanism
-                p.grad.data = GaussianMechanism(p.grad.data, sigma_g, max_norm, self.batch_size, self.use_cuda)
+            # DP mechanism: clipping single gradients + Gaussian noise
+            self.dp_step(sigma_g)
 
             self.optimizer.zero_grad()
 
@@ -136,16 +112,7 @@ class UserSCAFFOLD(User):
                 self.model.train()
 
                 # new batch (data sampling on every local epoch)
-                np.random.seed(500 * (self.times + 1) * (glob_iter + 1) + epoch + 1)
-                torch.manual_seed(500 * (self.times + 1) * (glob_iter + 1) + epoch + 1)
-                train_idx = np.arange(self.train_samples)
-                train_sampler = SubsetRandomSampler(train_idx)
-                self.trainloader = DataLoader(self.train_data, self.batch_size, sampler=train_sampler)
-
-                X, y = list(self.trainloader)[0]
-
-                if self.use_cuda:
-                    X, y = X.cuda(), y.cuda()
+                X, y = self.get_batch(500 * (self.times + 1) * (glob_iter + 1) + epoch + 1)
 
                 self.optimizer.zero_grad()
                 clear_backprops(self.model)
@@ -158,26 +125,10 @@ class UserSCAFFOLD(User):
                     self.scheduler.step()
 
         # get model difference
-        for local, server, delta in zip(self.model.parameters(), self.server_model, self.delta_model):
-            delta.data = local.data.detach() - server.data.detach()
+        self.update_delta_model()
 
         # get user new controls
-        new_controls = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
-        for server_control, control, new_control, delta in zip(self.server_controls, self.controls, new_controls,
-                                                               self.delta_model):
-            a = self.sample_ratio / (self.local_updates * self.learning_rate)
-            new_control.data = control.data - server_control.data - delta.data * a
-
-        # get controls differences
-        for control, new_control, delta in zip(self.controls, new_controls, self.delta_controls):
-            if (not warm_start) or glob_iter >= round(4 / user_ratio):
-                delta.data = new_control.data - control.data
-            else:
-                if not seen:
-                    delta.data = new_control.data
-                else:
-                    delta.data = new_control.data - control.data
-            control.data = new_control.data
+        self.update_controls(glob_iter, user_ratio, warm_start, seen)
 
         return 0
 
@@ -189,35 +140,16 @@ class UserSCAFFOLD(User):
                 self.model.train()
 
                 # new batch (data sampling on every local epoch)
-                np.random.seed(500 * (self.times + 1) * (glob_iter + 1) + epoch + 1)
-                torch.manual_seed(500 * (self.times + 1) * (glob_iter + 1) + epoch + 1)
-                train_idx = np.arange(self.train_samples)
-                train_sampler = SubsetRandomSampler(train_idx)
-                self.trainloader = DataLoader(self.train_data, self.batch_size, sampler=train_sampler)
-
-                X, y = list(self.trainloader)[0]
-
-                if self.use_cuda:
-                    X, y = X.cuda(), y.cuda()
+                X, y = self.get_batch(500 * (self.times + 1) * (glob_iter + 1) + epoch + 1)
 
                 self.optimizer.zero_grad()
                 clear_backprops(self.model)
                 output = self.model(X)
                 loss = self.loss(output, y)
                 loss.backward(retain_graph=True)
-                compute_grad1(self.model)
-
-                for p in self.model.parameters():
-                    # clipping single gradients
-
-                    # heuristic: otherwise, use max_norm constant
-                    max_norm = np.median([float(grad.data.norm(2)) for grad in p.grad1])
 
-                    p.grad1 = torch.stack(
-                        [grad / max(1, float(grad.data.norm(2)) / max_norm) for grad in p.grad1])
-                    p.grad.data = torch.mean(p.grad1, dim=0)
-                    # DP mechanism
-                    p.grad.data = GaussianMechanism(p.grad.data, sigma_g, max_norm, self.batch_size, self.use_cuda)
+                # DP mechanism: clipping single gradients + Gaussian noise
+                self.dp_step(sigma_g)
 
                 self.optimizer.step(self.server_controls, self.controls)
 
@@ -225,38 +157,51 @@ class UserSCAFFOLD(User):
                     self.scheduler.step()
 
         # get model difference
-        for local, server, delta in zip(self.model.parameters(), self.server_model, self.delta_model):
-            delta.data = local.data.detach() - server.data.detach()
+        self.update_delta_model()
 
         # get user new controls
-        new_controls = [torch.zeros_like(p.data) for p in self.model.parameters() if p.requires_grad]
+        self.update_controls(glob_iter, user_ratio, warm_start, seen)
+
+        return 0
+
+    def get_state(self):
+        state = super().get_state()
+        state['controls'] = [control.detach().clone() for control in self.controls]
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        for control, saved_control in zip(self.controls, state['controls']):
+            control.data = saved_control.to(self.device)
+
+    def get_deltas(self):
+        """Tensors sent to the server after the local updates: model and controls differences (views of
+        self.flat_deltas)."""
+        return self.delta_model + self.delta_controls
+
+    def update_controls(self, glob_iter, user_ratio, warm_start, seen):
+        """Updates the controls of the user (and their differences) from the model difference."""
+        new_controls = [torch.zeros_like(control.data) for control in self.controls]
         for server_control, control, new_control, delta in zip(self.server_controls, self.controls, new_controls,
                                                                self.delta_model):
-            a = 1 / (self.local_updates * self.learning_rate)
+            if self.dp == "None":
+                a = self.sample_ratio / (self.local_updates * self.learning_rate)
+            else:
+                a = 1 / (self.local_updates * self.learning_rate)
             new_control.data = control.data - server_control.data - delta.data * a
 
         # get controls differences
         for control, new_control, delta in zip(self.controls, new_controls, self.delta_controls):
             if (not warm_start) or glob_iter >= round(4 / user_ratio):
-                delta.data = new_control.data - control.data
+                delta.data.copy_(new_control.data - control.data)
             else:
                 if not seen:
-                    delta.data = new_control.data
+                    delta.data.copy_(new_control.data)
                 else:
-                    delta.data = new_control.data - control.data
+                    delta.data.copy_(new_control.data - control.data)
             control.data = new_control.data
 
-        return 0
-
     def get_params_norm(self):
         """Returns (||x_user^t+1 -x_server^t||,||c_user^t+1 -c_server^t||)."""
-        params = []
-        controls = []
-
-        for delta in self.delta_model:
-            params.append(torch.flatten(delta.data))
-
-        for delta in self.delta_controls:
-            controls.append(torch.flatten(delta.data))
-
-        return float(torch.norm(torch.cat(params))), float(torch.norm(torch.cat(controls)))
+        params, controls = self.flat_deltas.chunk(2)
+        return float(torch.norm(params)), float(torch.norm(controls))
@@ -1,8 +1,11 @@
 from utils.plot_utils import *
 import argparse
+import math
 from simulate import simulate
-from simulate import simulate_cross_validation
 from simulate import find_optimum
+from sweep import sweep_learning, sweep_tuning, tune
+from flearn.differential_privacy.accountant import calibrate_sigma, dp_parameters
+from utils.model_utils import UserDataStore
 from data.Mnist.data_generator import generate_data as generate_mnist_data
 from data.Mnist.data_generator import generate_pca_data as generate_mnist_pca_data
 from data.Femnist.data_generator import generate_data as generate_femnist_data
@@ -28,10 +31,28 @@ def generate_data(dataset, nb_users, nb_samples, dim_input=40, dim_output=10, si
                                normalise=normalise, standardize=standardize, iid=iid)
 
 
+def calibrated_sigma_gaussian(epsilon, dataset, number, similarities, dim_pca, num_glob_iters, local_updates,
+                              users_per_round, sample_ratio):
+    """Minimal sigma_gaussian (rounded up to 0.01) such that the DP epsilon bound is epsilon for the data of every
+    similarity, with the parameters (M, R, s, delta) of the privacy ledger of the servers (see dp_parameters)"""
+    sigmas = []
+    for similarity in similarities:
+        if dataset == 'Logistic':
+            similarity = "iid" if similarity[0] < 0 and similarity[1] < 0 else similarity
+        data_store = UserDataStore(dataset, str(number), str(similarity), dim_pca)
+        M, R, s, delta = dp_parameters([data_store.train_size(i) for i in range(len(data_store))], sample_ratio)
+        l = min(users_per_round, M) / M if users_per_round else 1.
+        sigmas.append(calibrate_sigma(epsilon, num_glob_iters, local_updates, M, R, l, s, delta))
+    return math.ceil(max(sigmas) * 100) / 100
+
+
 def run_simulation(time, dataset, algo, model, similarity, alpha, beta, number, dim_input, dim_output, same_sample_size,
                    nb_users, user_ratio, nb_samples, sample_ratio, local_updates, weight_decay, local_learning_rate,
                    max_norm, dp, sigma_gaussian, normalise, standardize, times, optimum, num_glob_iters, generate,
-                   generate_pca, dim_pca, tuning, learning, plot):
+                   generate_pca, dim_pca, tuning, learning, plot, lazy_data=False, executor="serial",
+                   cache_lowest=False, eval_every=1, eval_growth=1., eval_users=0, async_eval=False,
+                   checkpoint_every=0, resume=False, sweep_workers=0, sweep_threads=0, epsilon=0.,
+                   epsilon_budget=0.):
     if dataset == "Femnist":
         nb_users = 40
         nb_samples = 2500
@@ -114,6 +135,18 @@ def run_simulation(time, dataset, algo, model, similarity, alpha, beta, number,
 
     input_dict = {}
 
+    # options of the simulations (tuning and learning)
+    options = {"lazy_data": lazy_data,
+               "executor": executor,
+               "cache_lowest": cache_lowest,
+               "eval_every": eval_every,
+               "eval_growth": eval_growth,
+               "eval_users": eval_users,
+               "async_eval": async_eval,
+               "checkpoint_every": checkpoint_every,
+               "resume": resume,
+               "epsilon_budget": epsilon_budget}
+
     if dataset == 'Femnist':
         input_dict = femnist_dict
     elif dataset == 'Mnist':
@@ -139,6 +172,15 @@ def run_simulation(time, dataset, algo, model, similarity, alpha, beta, number,
     if dataset in ['Logistic']:
         similarities = list(zip(alphas, betas))
 
+    if dp == "Gaussian" and epsilon > 0 and (tuning or learning or plot):
+        # resolved once: the results of every branch (tuning, learning, plot) are named with this sigma_gaussian
+        sigma_gaussian = calibrated_sigma_gaussian(epsilon, dataset, number, similarities,
+                                                   dim_pca if input_dict["model"][-3:] == "PCA" else None,
+                                                   num_glob_iters, input_dict["local_updates"],
+                                                   int(nb_users * user_ratio), sample_ratio)
+        print(f"sigma_gaussian={sigma_gaussian} for epsilon={epsilon} (results named with this sigma_gaussian, "
+              f"run --plot with the same --epsilon or with --sigma_gaussian {sigma_gaussian})")
+
     if generate:
         if dataset in ['Femnist', 'Mnist', 'CIFAR_10']:
             for similarity in similarities:
@@ -181,18 +223,15 @@ def run_simulation(time, dataset, algo, model, similarity, alpha, beta, number,
                              dim_output=logistic_dict["dim_output"], alpha=alpha, beta=beta)
 
     elif tuning:
+        jobs = []  # one cross validation per setting, run for every lr (see sweep.tune)
         if dataset in ['Femnist', 'Mnist', 'CIFAR_10']:
             for similarity in similarities:
                 for noise in noises:
                     for dp in dps:
                         for algorithm in algorithms:
-                            for lr in local_learning_rate_list:
-                                input_dict["local_learning_rate"] = lr
-                                print("Hyperparameter :{}".format(lr))
-                                simulate_cross_validation(**input_dict, algorithm=algorithm, similarity=similarity,
-                                                          noise=noise, times=times, dp=dp,
-                                                          sigma_gaussian=sigma_gaussian,
-                                                          num_glob_iters=num_glob_iters)
+                            jobs.append(dict(input_dict, algorithm=algorithm, similarity=similarity, noise=noise,
+                                             times=times, dp=dp, sigma_gaussian=sigma_gaussian,
+                                             num_glob_iters=num_glob_iters, **options))
 
         if dataset in ['Logistic']:
             for similarity in similarities:
@@ -200,15 +239,18 @@ def run_simulation(time, dataset, algo, model, similarity, alpha, beta, number,
                 for noise in noises:
                     for dp in dps:
                         for algorithm in algorithms:
-                            for lr in local_learning_rate_list:
-                                input_dict["local_learning_rate"] = lr
-                                print("Hyperparameter :{}".format(lr))
-                                simulate_cross_validation(**input_dict, algorithm=algorithm, noise=noise,
-                                                          times=times, dp=dp, sigma_gaussian=sigma_gaussian,
-                                                          alpha=alpha, beta=beta,
-                                                          similarity=None, number=number, num_glob_iters=num_glob_iters)
+                            jobs.append(dict(input_dict, algorithm=algorithm, noise=noise, times=times, dp=dp,
+                                             sigma_gaussian=sigma_gaussian, alpha=alpha, beta=beta, similarity=None,
+                                             number=number, num_glob_iters=num_glob_iters, **options))
+
+        if sweep_workers > 0:
+            sweep_tuning(jobs, local_learning_rate_list, sweep_workers, sweep_threads)
+        else:
+            for job in jobs:
+                tune(job, local_learning_rate_list)
 
     elif learning:
+        jobs = []
         if dataset in ['Femnist', 'Mnist', 'CIFAR_10']:
             for similarity in similarities:
                 for noise in noises:
@@ -216,9 +258,9 @@ def run_simulation(time, dataset, algo, model, similarity, alpha, beta, number,
                         for algorithm in algorithms:
                             if algorithm == "FedSGD":  # SGD: one local epoch
                                 input_dict["local_updates"] = round(1 / input_dict["sample_ratio"])
-                            simulate(**input_dict, algorithm=algorithm, similarity=similarity, noise=noise,
-                                     times=times, dp=dp, sigma_gaussian=sigma_gaussian,
-                                     num_glob_iters=num_glob_iters, time=time)
+                            jobs.append(dict(input_dict, algorithm=algorithm, similarity=similarity, noise=noise,
+                                             times=times, dp=dp, sigma_gaussian=sigma_gaussian,
+                                             num_glob_iters=num_glob_iters, time=time, **options))
 
         if dataset in ['Logistic']:
             for similarity in similarities:
@@ -228,9 +270,15 @@ def run_simulation(time, dataset, algo, model, similarity, alpha, beta, number,
                         for algorithm in algorithms:
                             if algorithm == "FedSGD":  # SGD: one local epoch
                                 input_dict["local_updates"] = round(1 / input_dict["sample_ratio"])
-                            simulate(**input_dict, algorithm=algorithm, noise=noise,
-                                     times=times, dp=dp, sigma_gaussian=sigma_gaussian, alpha=alpha, beta=beta,
-                                     similarity=None, number=number, num_glob_iters=num_glob_iters, time=time)
+                            jobs.append(dict(input_dict, algorithm=algorithm, noise=noise, times=times, dp=dp,
+                                             sigma_gaussian=sigma_gaussian, alpha=alpha, beta=beta, similarity=None,
+                                             number=number, num_glob_iters=num_glob_iters, time=time, **options))
+
+        if sweep_workers > 0:
+            sweep_learning(jobs, sweep_workers, sweep_threads)
+        else:
+            for job in jobs:
+                simulate(**job)
     elif plot:
 
         # Plots with same sigma_gaussian, same T, same K, same l, same s + various similarities
@@ -320,6 +368,38 @@ if __name__ == "__main__":
     parser.add_argument("--dp", type=str, default="None", choices=["None", "Gaussian"],
                         help="Differential Privacy or not")
     parser.add_argument("--sigma_gaussian", type=float, default=10.0, help="Gaussian standard deviation for DP noise")
+    parser.add_argument("--epsilon", type=float, default=0.,
+                        help="If > 0: sigma_gaussian set to the minimal value with a DP epsilon bound below epsilon "
+                             "(see get_epsilon_bound.py)")
+    parser.add_argument("--epsilon_budget", type=float, default=0.,
+                        help="If > 0: training stopped before the DP epsilon spent exceeds epsilon_budget")
+
+    parser.add_argument("--lazy_data", type=int, default=0,
+                        help="If 1: users data is paged in from the memory-mapped data files only when needed")
+    parser.add_argument("--executor", type=str, default="serial", choices=["serial", "vmap", "thread", "process"],
+                        help="Local updates run user by user (serial), for all selected users at once (vmap), "
+                             "in a pool of threads (thread) or of worker processes (process)")
+
+    parser.add_argument("--cache_lowest", type=int, default=0,
+                        help="If 1: train losses of the reference model are saved next to it and reused by next runs")
+
+    parser.add_argument("--eval_every", type=int, default=1,
+                        help="Min nb of communication rounds between two evaluations of the global model")
+    parser.add_argument("--eval_growth", type=float, default=1.,
+                        help="If > 1: geometric schedule of the evaluations (next round >= eval_growth * round)")
+    parser.add_argument("--eval_users", type=int, default=0,
+                        help="If > 0: evaluation on a fixed random subset of eval_users users (unbiased estimates)")
+    parser.add_argument("--async_eval", type=int, default=0,
+                        help="If 1: evaluation in a background thread, during the local updates of the round")
+    parser.add_argument("--checkpoint_every", type=int, default=0,
+                        help="If > 0: nb of communication rounds between two checkpoints of a run")
+    parser.add_argument("--resume", type=int, default=0,
+                        help="If 1: runs resumed from their last checkpoint (see --checkpoint_every)")
+    parser.add_argument("--sweep_workers", type=int, default=0,
+                        help="If > 0: nb of processes running the simulations of tuning/learning in parallel "
+                             "(completed runs being skipped)")
+    parser.add_argument("--sweep_threads", type=int, default=0,
+                        help="Nb of cpus of every sweep process (0: cpus shared equally between the processes)")
 
     parser.add_argument("--generate", type=int, default=0,
                         help="True to generate data")
@@ -348,4 +428,9 @@ if __name__ == "__main__":
                    times=args.times, standardize=args.standardize,
                    optimum=args.optimum, num_glob_iters=args.num_glob_iters,
                    generate=args.generate, tuning=args.tuning, learning=args.learning, plot=args.plot,
-                   generate_pca=args.generate_pca, dim_pca=args.dim_pca)
+                   generate_pca=args.generate_pca, dim_pca=args.dim_pca, lazy_data=args.lazy_data,
+                   executor=args.executor, cache_lowest=args.cache_lowest,
+                   eval_every=args.eval_every, eval_growth=args.eval_growth, eval_users=args.eval_users,
+                   async_eval=args.async_eval, checkpoint_every=args.checkpoint_every, resume=args.resume,
+                   sweep_workers=args.sweep_workers, sweep_threads=args.sweep_threads, epsilon=args.epsilon,
+                   epsilon_budget=args.epsilon_budget)
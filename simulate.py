@@ -33,7 +33,9 @@ def find_optimum(dataset, model, number, dim_input, dim_output, dim_pca=None, si
 
 def simulate(dataset, algorithm, model, dim_input, dim_output, nb_users, nb_samples, sample_ratio, user_ratio,
              weight_decay, local_learning_rate, max_norm, local_updates, noise, times, dp, sigma_gaussian, dim_pca,
-             similarity=None, alpha=0., beta=0., number=0, num_glob_iters=400, time=None):
+             similarity=None, alpha=0., beta=0., number=0, num_glob_iters=400, time=None, lazy_data=False,
+             executor="serial", cache_lowest=False, eval_every=1, eval_growth=1., eval_users=0,
+             async_eval=False, checkpoint_every=0, resume=False, epsilon_budget=0., average=True):
     users_per_round = int(nb_users * user_ratio)
     L = weight_decay
 
@@ -94,21 +96,44 @@ def simulate(dataset, algorithm, model, dim_input, dim_output, nb_users, nb_samp
         if algorithm == "FedAvg" or algorithm == "FedSGD":
             server = FedAvg(dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L,
                             local_learning_rate, max_norm, num_glob_iters, local_updates, users_per_round, similarity,
-                            noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda)
+                            noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda,
+                            lazy_data=lazy_data, executor=executor,
+                            cache_lowest=cache_lowest, eval_every=eval_every, eval_growth=eval_growth,
+                            eval_users=eval_users, async_eval=async_eval,
+                            checkpoint_every=checkpoint_every, resume=resume,
+                            epsilon_budget=epsilon_budget)
 
         elif algorithm == "SCAFFOLD":
             server = SCAFFOLD(dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L,
                               local_learning_rate, max_norm, num_glob_iters, local_updates, users_per_round, similarity,
-                              noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda, warm_start=False)
+                              noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda, warm_start=False,
+                              lazy_data=lazy_data, executor=executor,
+                              cache_lowest=cache_lowest, eval_every=eval_every, eval_growth=eval_growth,
+                              eval_users=eval_users, async_eval=async_eval,
+                              checkpoint_every=checkpoint_every, resume=resume,
+                              epsilon_budget=epsilon_budget)
 
         elif algorithm == "SCAFFOLD-warm":
             server = SCAFFOLD(dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L,
                               local_learning_rate, max_norm, num_glob_iters, local_updates, users_per_round, similarity,
-                              noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda, warm_start=True)
+                              noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda, warm_start=True,
+                              lazy_data=lazy_data, executor=executor,
+                              cache_lowest=cache_lowest, eval_every=eval_every, eval_growth=eval_growth,
+                              eval_users=eval_users, async_eval=async_eval,
+                              checkpoint_every=checkpoint_every, resume=resume,
+                              epsilon_budget=epsilon_budget)
         server.train()
 
-    # Average results
+    # Average results (average=False: the runs are averaged later, see sweep.sweep_learning)
 
+    if average:
+        average_runs(dataset, algorithm, model[1], local_updates, sample_ratio, user_ratio, noise, times, dp,
+                     sigma_gaussian, similarity, alpha, beta, number, num_glob_iters)
+
+
+def average_runs(dataset, algorithm, model_name, local_updates, sample_ratio, user_ratio, noise, times, dp,
+                 sigma_gaussian, similarity=None, alpha=0., beta=0., number=0, num_glob_iters=400):
+    """Averages the results and the norms of the times runs of a simulation (see simulate)."""
     if similarity is None:
         similarity = (alpha, beta)
 
@@ -117,16 +142,18 @@ def simulate(dataset, algorithm, model, dim_input, dim_output, nb_users, nb_samp
 
     average_data(num_glob_iters=num_glob_iters, algorithm=algorithm, dataset=dataset, similarity=similarity,
                  noise=noise, times=times, number=str(number), dp=dp, sigma_gaussian=sigma_gaussian,
-                 local_updates=local_updates, sample_ratio=sample_ratio, user_ratio=user_ratio, model_name=model[1])
+                 local_updates=local_updates, sample_ratio=sample_ratio, user_ratio=user_ratio, model_name=model_name)
     average_norms(num_glob_iters=num_glob_iters, algorithm=algorithm, dataset=dataset, similarity=similarity,
                   noise=noise, times=times, number=str(number), dp=dp, sigma_gaussian=sigma_gaussian,
-                  local_updates=local_updates, sample_ratio=sample_ratio,user_ratio=user_ratio, model_name=model[1])
+                  local_updates=local_updates, sample_ratio=sample_ratio,user_ratio=user_ratio, model_name=model_name)
 
 
 def simulate_cross_validation(dataset, algorithm, model, dim_input, dim_pca, dim_output, nb_users, nb_samples,
                               sample_ratio, user_ratio, weight_decay, local_learning_rate, max_norm, local_updates,
                               noise, times, dp, sigma_gaussian, similarity=None, alpha=0., beta=0., number=0,
-                              num_glob_iters=400, nb_fold=5):
+                              num_glob_iters=400, nb_fold=5, lazy_data=False,
+                              executor="serial", cache_lowest=False, eval_every=1, eval_growth=1., eval_users=0,
+                              async_eval=False, checkpoint_every=0, resume=False, epsilon_budget=0.):
     users_per_round = int(nb_users * user_ratio)
     L = weight_decay
 
@@ -179,14 +206,22 @@ def simulate_cross_validation(dataset, algorithm, model, dim_input, dim_pca, dim
                 server = FedAvg(dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L,
                                 local_learning_rate, max_norm, num_glob_iters, local_updates, users_per_round,
                                 similarity, noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda,
-                                k_fold=k_fold, nb_fold=nb_fold)
+                                k_fold=k_fold, nb_fold=nb_fold, lazy_data=lazy_data, executor=executor,
+                                cache_lowest=cache_lowest, eval_every=eval_every, eval_growth=eval_growth,
+                                eval_users=eval_users, async_eval=async_eval,
+                                checkpoint_every=checkpoint_every, resume=resume,
+                                epsilon_budget=epsilon_budget)
 
             elif algorithm == "SCAFFOLD":
                 server = SCAFFOLD(dataset, algorithm, model, nb_users, nb_samples, user_ratio, sample_ratio, L,
                                   local_learning_rate, max_norm, num_glob_iters, local_updates, users_per_round,
                                   similarity, noise, i, dp, sigma_gaussian, alpha, beta, number, dim_pca, use_cuda,
                                   warm_start=False,
-                                  k_fold=k_fold, nb_fold=nb_fold)
+                                  k_fold=k_fold, nb_fold=nb_fold, lazy_data=lazy_data, executor=executor,
+                                  cache_lowest=cache_lowest, eval_every=eval_every, eval_growth=eval_growth,
+                                  eval_users=eval_users, async_eval=async_eval,
+                                  checkpoint_every=checkpoint_every, resume=resume,
+                                  epsilon_budget=epsilon_budget)
             server.train()
 
         # Average results
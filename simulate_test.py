@@ -0,0 +1,115 @@
+import json
+import os
+import shutil
+
+import h5py
+import numpy as np
+import pytest
+import torch
+
+import simulate
+from flearn.servers.server_base import Server
+from flearn.trainmodel.models import MclrLogistic
+from utils.model_utils import clear_data_cache
+
+NB_USERS, NB_SAMPLES, DIM_INPUT, DIM_OUTPUT = 10, 40, 8, 4
+SIMILARITY = "(1.0, 1.0)"
+
+
+@pytest.fixture
+def logistic_dir(tmp_path, monkeypatch):
+    """Small Logistic dataset and reference model (model_lowest) in a temporary working directory"""
+    monkeypatch.chdir(tmp_path)
+    clear_data_cache()
+    rng = np.random.RandomState(0)
+    for split, nb_samples in [("train", NB_SAMPLES), ("test", NB_SAMPLES // 4)]:
+        users = ["f_{0:05d}".format(i) for i in range(NB_USERS)]
+        user_data = {id: {"x": rng.randn(nb_samples, DIM_INPUT).tolist(),
+                          "y": rng.randint(DIM_OUTPUT, size=nb_samples).tolist()} for id in users}
+        os.makedirs(os.path.join("data", "Logistic", "data", split))
+        with open(os.path.join("data", "Logistic", "data", split, f"my{split}_0_{SIMILARITY}.json"), "w") as f:
+            json.dump({"users": users, "user_data": user_data, "num_samples": [nb_samples] * NB_USERS}, f)
+    os.makedirs(os.path.join("models", "Logistic", "mclr"))
+    torch.manual_seed(1)
+    torch.save(MclrLogistic(DIM_INPUT, DIM_OUTPUT), os.path.join("models", "Logistic", "mclr",
+                                                                 f"server_lowest_{SIMILARITY}.pt"))
+    yield tmp_path
+    clear_data_cache()
+
+
+def run(algorithm, dp, num_glob_iters, **kwargs):
+    """Runs the simulation (1 run) and returns its results and norms"""
+    simulate.simulate("Logistic", algorithm, "mclr", DIM_INPUT, DIM_OUTPUT, NB_USERS, NB_SAMPLES, 0.2, 0.3, 5e-3, 1.0,
+                      1.0, 5, False, 1, dp, 5.0, None, alpha=1.0, beta=1.0, num_glob_iters=num_glob_iters,
+                      average=False, **kwargs)
+    file_name = f"./results/mclr/Logistic_0_{algorithm}_{SIMILARITY}s_5K_0.2sr_0.3ur"
+    file_name += ("_5.0Gaussian" if dp != "None" else "") + "_0.h5"
+    values = {}
+    for name in [file_name, file_name.replace(algorithm, algorithm + "_norms")]:
+        with h5py.File(name, "r") as hf:
+            values.update({key: np.array(hf[key]) for key in hf.keys()})
+    return values
+
+
+@pytest.mark.parametrize("algorithm,dp", [("FedAvg", "Gaussian"), ("SCAFFOLD", "None")])
+def test_resume(logistic_dir, monkeypatch, algorithm, dp):
+    """A run interrupted after a checkpoint and resumed from it gives the results of the uninterrupted run"""
+    reference = run(algorithm, dp, 6)
+
+    crashed = []
+    evaluate = Server.evaluate
+
+    def crashing_evaluate(self, glob_iter, force=False):
+        if glob_iter == 4:
+            crashed.append(self)
+            raise KeyboardInterrupt
+        return evaluate(self, glob_iter, force)
+
+    monkeypatch.setattr(Server, "evaluate", crashing_evaluate)
+    with pytest.raises(KeyboardInterrupt):
+        run(algorithm, dp, 6, checkpoint_every=3)
+    server, = crashed
+    server.executor.close()
+    server.results.file.close()
+    server.norms.file.close()
+    monkeypatch.setattr(Server, "evaluate", evaluate)
+
+    resumed = run(algorithm, dp, 6, checkpoint_every=3, resume=True)
+    assert resumed.keys() == reference.keys()
+    for key in reference:
+        assert np.array_equal(resumed[key], reference[key]), key
+
+
+def test_cache_lowest(logistic_dir):
+    """The train losses of model_lowest read from their cache give the results computed without cache"""
+    reference = run("FedAvg", "None", 3)
+    run("FedAvg", "None", 3, cache_lowest=True)
+    assert any(f.startswith(f"server_lowest_{SIMILARITY}_losses") for f in os.listdir("models/Logistic/mclr"))
+    cached = run("FedAvg", "None", 3, cache_lowest=True)
+    for key in reference:
+        assert np.array_equal(cached[key], reference[key]), key
+
+
+def run_cross_validation(local_learning_rates, **kwargs):
+    """Runs the cross validation (2 folds) for every local learning rate and returns all the results saved"""
+    for lr in local_learning_rates:
+        simulate.simulate_cross_validation("Logistic", "FedAvg", "mclr", DIM_INPUT, None, DIM_OUTPUT, NB_USERS,
+                                           NB_SAMPLES, 0.2, 0.3, 5e-3, lr, 1.0, 5, False, 1, "Gaussian", 5.0,
+                                           alpha=1.0, beta=1.0, num_glob_iters=4, nb_fold=2, **kwargs)
+    values = {}
+    for root, _, files in os.walk("results"):
+        for name in files:
+            with h5py.File(os.path.join(root, name), "r") as hf:
+                values.update({(name, key): np.array(hf[key]) for key in hf.keys()})
+    return values
+
+
+def test_cross_validation_checkpoints(logistic_dir):
+    """The folds and learning rates of a cross validation have their own checkpoints, removed once trained"""
+    reference = run_cross_validation([1.0, 0.5])
+    shutil.rmtree("results")
+    checkpointed = run_cross_validation([1.0, 0.5], checkpoint_every=2, resume=True)
+    assert checkpointed.keys() == reference.keys()
+    for key in reference:
+        assert np.array_equal(checkpointed[key], reference[key]), key
+    assert not [name for _, _, files in os.walk("checkpoints") for name in files]
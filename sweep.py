@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+import os
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import h5py
+import torch
+from simulate import simulate, simulate_cross_validation, average_runs
+from utils.plot_utils import read_rounds
+from utils.results_utils import results_file_name
+
+
+def job_results_file_name(job, time, name=""):
+    """Name of the h5 file of the results of the run time of job (keyword arguments of simulate), as saved by the
+    server (see utils.results_utils.results_file_name; name: "" for the metrics, "_norms" for the norms)"""
+    similarity = job.get("similarity")
+    alpha, beta = job.get("alpha", 0.), job.get("beta", 0.)
+    if similarity is None:
+        similarity = (alpha, beta)
+    if alpha < 0 and beta < 0:
+        similarity = "iid"
+    return results_file_name(job["model"], job["dataset"], job.get("number", 0), job["algorithm"], similarity,
+                             job["local_updates"], job["sample_ratio"], job["user_ratio"], job["dp"],
+                             job["sigma_gaussian"], job["noise"], time, name)
+
+
+def run_completed(job, time):
+    """True if the results of the run time of job are completed: closed at the end of training (see
+    utils.results_utils.ResultsWriter), or, for the results saved without this attribute, saved up to the last round"""
+    num_glob_iters = job.get("num_glob_iters", 400)
+    try:
+        with h5py.File(job_results_file_name(job, time), 'r', swmr=True) as hf:
+            completed = hf.attrs.get('completed')
+        with h5py.File(job_results_file_name(job, time, "_norms"), 'r', swmr=True) as hf:
+            nb_norms = len(hf['rs_param_norms'])
+            completed_norms = hf.attrs.get('completed')
+        if completed is not None and completed_norms is not None:
+            return bool(completed) and bool(completed_norms)
+        rounds = read_rounds(job_results_file_name(job, time))
+    except (OSError, KeyError):
+        return False
+    return len(rounds) > 0 and rounds[-1] == num_glob_iters - 1 and nb_norms == num_glob_iters
+
+
+def average_job(job):
+    """Averages the runs of job (see simulate.average_runs) if they are all completed"""
+    if not all(run_completed(job, i) for i in range(job["times"])):
+        print("Runs not all completed, results not averaged:", job_results_file_name(job, "*"))
+        return
+    average_runs(job["dataset"], job["algorithm"], job["model"], job["local_updates"], job["sample_ratio"],
+                 job["user_ratio"], job["noise"], job["times"], job["dp"], job["sigma_gaussian"],
+                 job.get("similarity"), job.get("alpha", 0.), job.get("beta", 0.), job.get("number", 0),
+                 job.get("num_glob_iters", 400))
+
+
+def tune(job, learning_rates):
+    """Cross validation of job (keyword arguments of simulate_cross_validation) for every local learning rate"""
+    for lr in learning_rates:
+        print("Hyperparameter :{}".format(lr))
+        simulate_cross_validation(**dict(job, local_learning_rate=lr))
+
+
+def _init_worker(slots, nb_threads):
+    """Pins the worker process to nb_threads cpus (given by its slot in the pool), torch using as many threads"""
+    with slots.get_lock():
+        slot = slots.value
+        slots.value += 1
+    torch.set_num_threads(nb_threads)
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[(slot * nb_threads + i) % len(cpus)] for i in range(nb_threads)})
+
+
+def get_pool(nb_workers, nb_threads=0):
+    """Local pool of nb_workers processes (spawned: safe with CUDA and the threads of torch).
+    :param nb_threads : nb of cpus of every worker (0: cpus shared equally between the workers)"""
+    nb_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    if nb_threads <= 0:
+        nb_threads = max(nb_cpus // nb_workers, 1)
+    context = mp.get_context("spawn")
+    return ProcessPoolExecutor(nb_workers, mp_context=context, initializer=_init_worker,
+                               initargs=(context.Value('i', 0), nb_threads))
+
+
+def sweep_learning(jobs, nb_workers, nb_threads=0):
+    """Runs the simulations jobs (keyword arguments of simulate) in a local pool of nb_workers processes, with one
+    task per run of every job, the runs already completed being skipped. The runs of a job are averaged as soon as
+    they are all completed.
+    :param nb_threads : nb of cpus of every worker (see get_pool)"""
+    tasks = {}
+    remaining = []
+    failed = []
+    with get_pool(nb_workers, nb_threads) as pool:
+        for index, job in enumerate(jobs):
+            beg, end = 0, job["times"]
+            if job.get("time") is not None:  # to process only 1 run
+                beg, end = job["time"], min(job["time"] + 1, job["times"])
+            runs = [i for i in range(beg, end) if not run_completed(job, i)]
+            print(f"Job {index}: {end - beg - len(runs)} run(s) already completed, {len(runs)} to run")
+            remaining.append(len(runs))
+            for i in runs:
+                tasks[pool.submit(simulate, **dict(job, time=i, average=False))] = index
+            if not runs:
+                average_job(job)
+
+        for future in as_completed(tasks):
+            index = tasks[future]
+            if future.exception() is not None:
+                print(f"Job {index} failed:", future.exception())
+                failed.append(index)
+            remaining[index] -= 1
+            if remaining[index] == 0 and index not in failed:
+                average_job(jobs[index])
+    assert not failed, f"{len(set(failed))} job(s) failed"
+
+
+def sweep_tuning(jobs, learning_rates, nb_workers, nb_threads=0):
+    """Runs the cross validations jobs (keyword arguments of simulate_cross_validation) for every local learning rate
+    in a local pool of nb_workers processes, with one task per job: the folds and learning rates of a job share the
+    result files of its runs, so that they are run in sequence.
+    :param nb_threads : nb of cpus of every worker (see get_pool)"""
+    failed = []
+    with get_pool(nb_workers, nb_threads) as pool:
+        tasks = {pool.submit(tune, job, learning_rates): index for index, job in enumerate(jobs)}
+        for future in as_completed(tasks):
+            if future.exception() is not None:
+                print(f"Job {tasks[future]} failed:", future.exception())
+                failed.append(tasks[future])
+    assert not failed, f"{len(failed)} job(s) failed"
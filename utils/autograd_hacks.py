@@ -3,7 +3,7 @@ For more information, see https://github.com/cybertronai/autograd-hacks
 
 Library for extracting interesting quantites from autograd, see README.
 
-Not thread-safe because of module-level variables
+Not thread-safe because of module-level variables (except disable_hooks/enable_hooks, which act on the current thread)
 
 Notation:
 o: number of output classes (exact Hessian), number of Hessian samples (sampled Hessian)
@@ -24,13 +24,15 @@ B, backprops: backprop values (aka Lop aka Jacobian-vector product) observed at
 """
 
 from typing import List
+import threading
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 _supported_layers = ['Linear', 'Conv2d']  # Supported layer class types
-_hooks_disabled: bool = False           # work-around for https://github.com/pytorch/pytorch/issues/25723
+_hooks_state = threading.local()        # work-around for https://github.com/pytorch/pytorch/issues/25723
+_hooks_state.disabled = False           # (per thread, see _hooks_disabled)
 _enforce_fresh_backprop: bool = False   # global switch to catch double backprop errors on Hessian computation
 
 
@@ -48,8 +50,7 @@ def add_hooks(model: nn.Module) -> None:
         model:
     """
 
-    global _hooks_disabled
-    _hooks_disabled = False
+    _hooks_state.disabled = False
 
     handles = []
     for layer in model.modules():
@@ -77,18 +78,20 @@ def remove_hooks(model: nn.Module) -> None:
 
 def disable_hooks() -> None:
     """
-    Globally disable all hooks installed by this library.
+    Disable all hooks installed by this library in the current thread.
     """
 
-    global _hooks_disabled
-    _hooks_disabled = True
+    _hooks_state.disabled = True
 
 
 def enable_hooks() -> None:
     """the opposite of disable_hooks()"""
 
-    global _hooks_disabled
-    _hooks_disabled = False
+    _hooks_state.disabled = False
+
+
+def _hooks_disabled() -> bool:
+    return getattr(_hooks_state, 'disabled', False)
 
 
 def is_supported(layer: nn.Module) -> bool:
@@ -104,7 +107,7 @@ def _layer_type(layer: nn.Module) -> str:
 def _capture_activations(layer: nn.Module, input: List[torch.Tensor], output: torch.Tensor):
     """Save activations into layer.activations in forward pass"""
 
-    if _hooks_disabled:
+    if _hooks_disabled():
         return
     assert _layer_type(layer) in _supported_layers, "Hook installed on unsupported layer, this shouldn't happen"
     setattr(layer, "activations", input[0].detach())
@@ -114,7 +117,7 @@ def _capture_backprops(layer: nn.Module, _input, output):
     """Append backprop to layer.backprops_list in backward pass."""
     global _enforce_fresh_backprop
 
-    if _hooks_disabled:
+    if _hooks_disabled():
         return
 
     if _enforce_fresh_backprop:
@@ -173,6 +176,92 @@ def compute_grad1(model: nn.Module, loss_type: str = 'mean') -> None:
                 setattr(layer.bias, 'grad1', torch.sum(B, dim=2))
 
 
+def compute_grad_norms(model: nn.Module, loss_type: str = 'mean') -> None:
+    """
+    Compute per-example gradient norms without materializing per-example gradients ("ghost clipping") and save them
+    under 'param.grad_norm1'. Must be called after loss.backprop()
+
+    Linear: |grad_i| = |A_i| |B_i|
+    Conv2d: |grad_i|^2 = <A_i^T A_i, B_i^T B_i> (Gram matrices over output positions) if cheaper than grad_i
+
+    Args:
+        model:
+        loss_type: either "mean" or "sum" depending whether backpropped loss was averaged or summed over batch
+    """
+
+    for layer in model.modules():
+        layer_type = _layer_type(layer)
+        if layer_type not in _supported_layers:
+            continue
+        A, B = _activations_and_backprops(layer, loss_type)
+        n = A.shape[0]
+
+        if layer_type == 'Linear':
+            setattr(layer.weight, 'grad_norm1', A.norm(dim=1) * B.norm(dim=1))
+            if layer.bias is not None:
+                setattr(layer.bias, 'grad_norm1', B.norm(dim=1))
+
+        elif layer_type == 'Conv2d':
+            A = torch.nn.functional.unfold(A, layer.kernel_size)  # n, di * Kh * Kw, Oh * Ow
+            B = B.reshape(n, -1, A.shape[-1])                      # n, do, Oh * Ow
+            if A.shape[-1] ** 2 < A.shape[1] * B.shape[1]:
+                norm2 = torch.sum(torch.einsum('nkl,nkm->nlm', A, A) * torch.einsum('ndl,ndm->nlm', B, B), dim=(1, 2))
+            else:
+                norm2 = torch.einsum('ndl,nkl->ndk', B, A).flatten(1).pow(2).sum(dim=1)
+            setattr(layer.weight, 'grad_norm1', norm2.clamp(min=0).sqrt())
+            if layer.bias is not None:
+                setattr(layer.bias, 'grad_norm1', torch.sum(B, dim=2).norm(dim=1))
+
+
+def clipped_grad_sum(model: nn.Module, factors: dict, loss_type: str = 'mean') -> None:
+    """
+    Compute the weighted sum of per-example gradients sum_i factors[param][i] * grad_i without materializing
+    per-example gradients and save it under 'param.grad_sum'. Must be called after loss.backprop()
+
+    Args:
+        model:
+        factors: dictionary {param: tensor of shape [n]} with weights of the examples (e.g. clipping factors)
+        loss_type: either "mean" or "sum" depending whether backpropped loss was averaged or summed over batch
+    """
+
+    for layer in model.modules():
+        layer_type = _layer_type(layer)
+        if layer_type not in _supported_layers:
+            continue
+        A, B = _activations_and_backprops(layer, loss_type)
+        n = A.shape[0]
+
+        if layer_type == 'Linear':
+            setattr(layer.weight, 'grad_sum', torch.einsum('n,ni,nj->ij', factors[layer.weight], B, A))
+            if layer.bias is not None:
+                setattr(layer.bias, 'grad_sum', torch.einsum('n,ni->i', factors[layer.bias], B))
+
+        elif layer_type == 'Conv2d':
+            A = torch.nn.functional.unfold(A, layer.kernel_size)
+            B = B.reshape(n, -1, A.shape[-1])
+            grad_sum = torch.einsum('n,ndl,nkl->dk', factors[layer.weight], B, A)
+            setattr(layer.weight, 'grad_sum', grad_sum.reshape(layer.weight.shape))
+            if layer.bias is not None:
+                setattr(layer.bias, 'grad_sum', torch.einsum('n,ndl->d', factors[layer.bias], B))
+
+
+def _activations_and_backprops(layer: nn.Module, loss_type: str):
+    """Returns activations and backprops (per example) of layer"""
+
+    assert loss_type in ('sum', 'mean')
+    assert hasattr(layer, 'activations'), "No activations detected, run forward after add_hooks(model)"
+    assert hasattr(layer, 'backprops_list'), "No backprops detected, run backward after add_hooks(model)"
+    assert len(layer.backprops_list) == 1, "Multiple backprops detected, make sure to call clear_backprops(model)"
+
+    A = layer.activations
+    n = A.shape[0]
+    if loss_type == 'mean':
+        B = layer.backprops_list[0] * n
+    else:  # loss_type == 'sum':
+        B = layer.backprops_list[0]
+    return A, B
+
+
 def compute_hess(model: nn.Module,) -> None:
     """Save Hessian under param.hess for each param in the model"""
 
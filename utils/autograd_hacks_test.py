@@ -90,6 +90,33 @@ def test_grad1():
             assert torch.allclose(jacobian(losses, param), param.grad1)
 
 
+def test_grad_norms():
+    torch.manual_seed(1)
+    model = Net()
+    loss_fn = nn.CrossEntropyLoss()
+
+    n = 4
+    data = torch.rand(n, 1, 28, 28)
+    targets = torch.LongTensor(n).random_(0, 10)
+
+    autograd_hacks.add_hooks(model)
+    output = model(data)
+    loss_fn(output, targets).backward(retain_graph=True)
+    autograd_hacks.compute_grad1(model)
+    autograd_hacks.compute_grad_norms(model)
+    factors = {param: torch.rand(n) for param in model.parameters()}
+    autograd_hacks.clipped_grad_sum(model, factors)
+    autograd_hacks.disable_hooks()
+
+    # Compare values against per-example gradients
+    for layer in model.modules():
+        if not autograd_hacks.is_supported(layer):
+            continue
+        for param in layer.parameters():
+            assert torch.allclose(param.grad_norm1, param.grad1.flatten(1).norm(dim=1), rtol=1e-4)
+            assert torch.allclose(param.grad_sum, torch.tensordot(factors[param], param.grad1, dims=1), atol=1e-6)
+
+
 def test_hess():
     subtest_hess_type('CrossEntropy')
     subtest_hess_type('LeastSquares')
@@ -1,8 +1,109 @@
 import json
 import numpy as np
 import os
+import threading
+from collections import OrderedDict
 import torch
 import torch.nn as nn
+from torch.utils.data import TensorDataset
+
+
+def flat_buffer(tensors):
+    """Rebinds tensors (parameters or plain tensors, values kept) to views of one contiguous flat vector
+
+    Returns:
+        flat vector, in-place operations on it being applied to tensors
+    """
+    flat = torch.cat([t.data.flatten() for t in tensors])
+    offset = 0
+    for t in tensors:
+        t.data = flat[offset:offset + t.numel()].view_as(t)
+        offset += t.numel()
+    return flat
+
+
+def save_binary_data(json_path, data):
+    """Saves data (dictionary with keys 'users', 'user_data' and optionally 'hierarchies') next to json_path in a binary
+    columnar format
+
+    Files written (with json_path stripped from its '.json' extension):
+    - *.x.npy: inputs of all users, stored contiguously (float32)
+    - *.y.npy: labels of all users, stored contiguously (int64)
+    - *.offsets.npy: data of user i is stored between offsets[i] and offsets[i+1] (int64)
+    - *.users.npy: list of user ids
+    - *.groups.npy: list of group ids (empty if no 'hierarchies')
+    Each file is written to a temporary file and renamed, *.groups.npy last: once it exists, the other files are
+    complete (see read_data_files), even if several processes convert the same file at the same time.
+    """
+    base_path = json_path[:-len('.json')]
+    users = list(data['users'])
+    X = [np.asarray(data['user_data'][id]['x'], dtype=np.float32) for id in users]
+    y = [np.asarray(data['user_data'][id]['y'], dtype=np.int64) for id in users]
+    offsets = np.insert(np.cumsum([len(y_user) for y_user in y]), 0, 0).astype(np.int64)
+
+    arrays = [('.x.npy', np.concatenate(X)), ('.y.npy', np.concatenate(y)), ('.offsets.npy', offsets),
+              ('.users.npy', np.array(users)), ('.groups.npy', np.array(data.get('hierarchies', [])))]
+    for extension, array in arrays:
+        tmp_path = base_path + extension + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        with open(tmp_path, 'wb') as outfile:
+            np.save(outfile, array)
+        os.replace(tmp_path, base_path + extension)
+
+
+def load_binary_data(json_path):
+    """Memory-maps data saved by save_binary_data
+
+    Returns:
+        users: list of user ids
+        groups: list of group ids
+        user_data: dictionary of user data, 'x' and 'y' being views of the memory-mapped arrays
+    """
+    base_path = json_path[:-len('.json')]
+    X = np.load(base_path + '.x.npy', mmap_mode='r')
+    y = np.load(base_path + '.y.npy', mmap_mode='r')
+    offsets = np.load(base_path + '.offsets.npy')
+    users = np.load(base_path + '.users.npy').tolist()
+    groups = np.load(base_path + '.groups.npy').tolist()
+
+    user_data = {}
+    for i, id in enumerate(users):
+        user_data[id] = {'x': X[offsets[i]:offsets[i + 1]], 'y': y[offsets[i]:offsets[i + 1]]}
+    return users, groups, user_data
+
+
+def read_data_files(data_dir, number, similarity, dim_pca=None):
+    """Parses the data files of data_dir matching (number, similarity, dim_pca)
+
+    The binary version of each .json file is created at the first reading (or if the .json file is more recent),
+    then every reading memory-maps it.
+
+    Returns:
+        users: list of user ids
+        groups: list of group ids; empty list if none found
+        user_data: dictionary of user data
+    """
+    users = []
+    groups = []
+    user_data = {}
+
+    files = os.listdir(data_dir)
+    if dim_pca is not None:
+        files = [f for f in files if f.endswith(number + '_' + similarity + '_' + 'pca' + str(dim_pca) + '.json')]
+    else:
+        files = [f for f in files if f.endswith(number + '_' + similarity + '.json')]
+    for f in files:
+        file_path = os.path.join(data_dir, f)
+        binary_path = file_path[:-len('.json')] + '.groups.npy'  # last file written by save_binary_data
+        if not os.path.exists(binary_path) or os.path.getmtime(binary_path) < os.path.getmtime(file_path):
+            with open(file_path, 'r') as inf:
+                cdata = json.load(inf)
+            save_binary_data(file_path, cdata)
+        cusers, cgroups, cuser_data = load_binary_data(file_path)
+        users.extend(cusers)
+        groups.extend(cgroups)
+        user_data.update(cuser_data)
+
+    return users, groups, user_data
 
 
 def read_data(dataset, number, similarity, dim_pca=None):
@@ -10,7 +111,7 @@ def read_data(dataset, number, similarity, dim_pca=None):
 
     Assumes:
     - the data in the input directories are .json files with 
-        keys 'users' and 'user_data'
+        keys 'users' and 'user_data' (memory-mapped from their binary version, see read_data_files)
     - the set of train set users is the same as the set of test set users
 
     Returns:
@@ -22,37 +123,9 @@ def read_data(dataset, number, similarity, dim_pca=None):
 
     train_data_dir = os.path.join('data', dataset, 'data', 'train')
     test_data_dir = os.path.join('data', dataset, 'data', 'test')
-    users = []
-    groups = []
-    train_data = {}
-    test_data = {}
 
-    train_files = os.listdir(train_data_dir)
-    if dim_pca is not None:
-        train_files = [f for f in train_files if
-                       f.endswith(number + '_' + similarity + '_' + 'pca' + str(dim_pca) + '.json')]
-    else:
-        train_files = [f for f in train_files if f.endswith(number + '_' + similarity + '.json')]
-    for f in train_files:
-        file_path = os.path.join(train_data_dir, f)
-        with open(file_path, 'r') as inf:
-            cdata = json.load(inf)
-        users.extend(cdata['users'])
-        if 'hierarchies' in cdata:
-            groups.extend(cdata['hierarchies'])
-        train_data.update(cdata['user_data'])
-
-    test_files = os.listdir(test_data_dir)
-    if dim_pca is not None:
-        test_files = [f for f in test_files if
-                      f.endswith(number + '_' + similarity + '_' + 'pca' + str(dim_pca) + '.json')]
-    else:
-        test_files = [f for f in test_files if f.endswith(number + '_' + similarity + '.json')]
-    for f in test_files:
-        file_path = os.path.join(test_data_dir, f)
-        with open(file_path, 'r') as inf:
-            cdata = json.load(inf)
-        test_data.update(cdata['user_data'])
+    users, groups, train_data = read_data_files(train_data_dir, number, similarity, dim_pca)
+    _, _, test_data = read_data_files(test_data_dir, number, similarity, dim_pca)
 
     users = list(sorted(train_data.keys()))
 
@@ -76,39 +149,24 @@ def read_data_cross_validation(dataset, number, similarity, k_fold, nb_fold, dim
         test_data: dictionary of test data
     """
     train_data_dir = os.path.join('data', dataset, 'data', 'train')
-    users = []
-    groups = []
-    all_data = {}
     train_data = {}
     test_data = {}
 
     print(dim_pca)
 
-    train_files = os.listdir(train_data_dir)
-    if dim_pca is not None:
-        train_files = [f for f in train_files if
-                       f.endswith(number + '_' + similarity + '_' + 'pca' + str(dim_pca) + '.json')]
-    else:
-        train_files = [f for f in train_files if f.endswith(number + '_' + similarity + '.json')]
-    for f in train_files:
-        file_path = os.path.join(train_data_dir, f)
-        with open(file_path, 'r') as inf:
-            cdata = json.load(inf)
-        users.extend(cdata['users'])
-        if 'hierarchies' in cdata:
-            groups.extend(cdata['hierarchies'])
-        all_data.update(cdata['user_data'])
+    users, groups, all_data = read_data_files(train_data_dir, number, similarity, dim_pca)
 
     users = list(sorted(all_data.keys()))
     train_len = len(all_data[users[0]]['x'])
 
     for index in range(len(users)):
         id = users[index]
+        # the two memory-mapped views around the fold, concatenated when the tensors are created (see user_array)
         train_data[id] = {
-            'x': all_data[id]['x'][:round(k_fold * train_len / nb_fold)] + all_data[id]['x'][
-                                                                           round((k_fold + 1) * train_len / nb_fold):],
-            'y': all_data[id]['y'][:round(k_fold * train_len / nb_fold)] + all_data[id]['y'][
-                                                                           round((k_fold + 1) * train_len / nb_fold):]}
+            'x': (all_data[id]['x'][:round(k_fold * train_len / nb_fold)],
+                  all_data[id]['x'][round((k_fold + 1) * train_len / nb_fold):]),
+            'y': (all_data[id]['y'][:round(k_fold * train_len / nb_fold)],
+                  all_data[id]['y'][round((k_fold + 1) * train_len / nb_fold):])}
         test_data[id] = {
             'x': all_data[id]['x'][round(k_fold * train_len / nb_fold):round((k_fold + 1) * train_len / nb_fold)],
             'y': all_data[id]['y'][round(k_fold * train_len / nb_fold):round((k_fold + 1) * train_len / nb_fold)]}
@@ -116,27 +174,152 @@ def read_data_cross_validation(dataset, number, similarity, k_fold, nb_fold, dim
     return users, groups, train_data, test_data
 
 
+def user_array(array):
+    """Array of a user: memory-mapped view, or tuple of memory-mapped views (train data of a cross validation, see
+    read_data_cross_validation) concatenated"""
+    return np.concatenate(array) if isinstance(array, tuple) else array
+
+
+def user_size(array):
+    """Nb of samples of an array of a user (see user_array), without concatenating it"""
+    return sum(len(part) for part in array) if isinstance(array, tuple) else len(array)
+
+
 def read_user_data(index, data, dataset):
     """Returns:
         id: id of user
-        train_data: list of (data, labels) for training
-        test_data: list of (data, labels) for testing
+        train_data: TensorDataset (data, labels) for training
+        test_data: TensorDataset (data, labels) for testing
     """
     id = data[0][index]
     train_data = data[2][id]
     test_data = data[3][id]
-    X_train, y_train, X_test, y_test = train_data['x'], train_data['y'], test_data['x'], test_data['y']
+    X_train, y_train = user_array(train_data['x']), user_array(train_data['y'])
+    X_test, y_test = test_data['x'], test_data['y']
     if dataset == "CIFAR-10":
-        X_train = torch.Tensor(X_train).view(-1, 3, 32, 32).type(torch.float32)
-        y_train = torch.Tensor(y_train).type(torch.int64)
-        X_test = torch.Tensor(X_test).view(-1, 3, 32, 32).type(torch.float32)
-        y_test = torch.Tensor(y_test).type(torch.int64)
+        X_train = torch.from_numpy(np.array(X_train, dtype=np.float32)).view(-1, 3, 32, 32)
+        y_train = torch.from_numpy(np.array(y_train, dtype=np.int64))
+        X_test = torch.from_numpy(np.array(X_test, dtype=np.float32)).view(-1, 3, 32, 32)
+        y_test = torch.from_numpy(np.array(y_test, dtype=np.int64))
     else:
         # image flattened for FEMNIST, MNIST
-        X_train = torch.Tensor(X_train).type(torch.float32)
-        y_train = torch.Tensor(y_train).type(torch.int64)
-        X_test = torch.Tensor(X_test).type(torch.float32)
-        y_test = torch.Tensor(y_test).type(torch.int64)
-    train_data = [(x, y) for x, y in zip(X_train, y_train)]
-    test_data = [(x, y) for x, y in zip(X_test, y_test)]
+        X_train = torch.from_numpy(np.array(X_train, dtype=np.float32))
+        y_train = torch.from_numpy(np.array(y_train, dtype=np.int64))
+        X_test = torch.from_numpy(np.array(X_test, dtype=np.float32))
+        y_test = torch.from_numpy(np.array(y_test, dtype=np.int64))
+    train_data = TensorDataset(X_train, y_train)
+    test_data = TensorDataset(X_test, y_test)
     return id, train_data, test_data
+
+
+class CachedData:
+    """Data of all users (see read_data, read_data_cross_validation) and tensors of the users created from it
+    (see read_user_data), shared by the UserDataStore of the process (see get_cached_data)
+    """
+
+    def __init__(self, dataset, number, similarity, dim_pca=None, k_fold=None, nb_fold=None):
+        if k_fold is None:
+            self.data = read_data(dataset, number, similarity, dim_pca)
+        else:
+            # Cross Validation
+            self.data = read_data_cross_validation(dataset, number, similarity, k_fold, nb_fold, dim_pca)
+        self.dataset = dataset
+        self.user_data = {}
+        self.federation_data = None
+
+    def read_user_data(self, index):
+        """Tensors of user index, created at the first reading"""
+        if index not in self.user_data:
+            self.user_data.setdefault(index, read_user_data(index, self.data, self.dataset))
+        return self.user_data[index]
+
+    def read_federation_data(self):
+        """Tensors of all users concatenated, created at the first reading: the tensors of the users are then views of
+        them, so that the data is held once by the process
+
+        Returns:
+            train_data: (X, y, nb of samples of every user)
+            test_data: (X, y, nb of samples of every user)
+        """
+        if self.federation_data is None:
+            user_data = [self.read_user_data(index) for index in range(len(self.data[0]))]
+            federation_data = []
+            views = []
+            for split in [1, 2]:
+                datasets = [data[split].tensors for data in user_data]
+                X, y = torch.cat([X for X, _ in datasets]), torch.cat([y for _, y in datasets])
+                counts = torch.tensor([len(y) for _, y in datasets])
+                offsets = (torch.cumsum(counts, 0) - counts).tolist()
+                federation_data.append((X, y, counts))
+                views.append([TensorDataset(X[start:start + len(y_user)], y[start:start + len(y_user)])
+                              for start, (_, y_user) in zip(offsets, datasets)])
+            for index, (id, _, _) in enumerate(user_data):
+                self.user_data[index] = (id, views[0][index], views[1][index])
+            self.federation_data = tuple(federation_data)
+        return self.federation_data
+
+
+# cached data of the process, least recently used first (see get_cached_data)
+_cached_data = OrderedDict()
+_cached_data_lock = threading.Lock()
+data_cache_size = 4
+
+
+def get_cached_data(dataset, number, similarity, dim_pca=None, k_fold=None, nb_fold=None):
+    """Returns the CachedData of (dataset, number, similarity, dim_pca, k_fold, nb_fold), so that the data files are
+    parsed once per process for all the runs, algorithms and folds. The data_cache_size most recently used are kept."""
+    key = (dataset, number, similarity, dim_pca, k_fold, nb_fold)
+    with _cached_data_lock:
+        if key in _cached_data:
+            _cached_data.move_to_end(key)
+            return _cached_data[key]
+    cached_data = CachedData(dataset, number, similarity, dim_pca, k_fold, nb_fold)
+    with _cached_data_lock:
+        cached_data = _cached_data.setdefault(key, cached_data)
+        _cached_data.move_to_end(key)
+        while len(_cached_data) > data_cache_size:
+            _cached_data.popitem(last=False)
+    return cached_data
+
+
+def clear_data_cache():
+    with _cached_data_lock:
+        _cached_data.clear()
+
+
+class UserDataStore:
+    """Data of all users, memory-mapped from the binary data files (see read_data, read_data_cross_validation)
+
+    Users only keep their index in the store: their tensors are created from the memory-mapped arrays when they are
+    needed (user selected or evaluated). If lazy, users drop their tensors after use, so that the number of users is
+    not limited by the RAM. Otherwise, the tensors are kept in the cache of the process (see get_cached_data) and
+    shared by the next stores of the same data.
+    """
+
+    def __init__(self, dataset, number, similarity, dim_pca=None, k_fold=None, nb_fold=None, lazy=False):
+        self.cached_data = get_cached_data(dataset, number, similarity, dim_pca, k_fold, nb_fold)
+        self.data = self.cached_data.data
+        self.dataset = dataset
+        self.k_fold = k_fold
+        self.nb_fold = nb_fold
+        self.lazy = lazy
+        self.users = self.data[0]
+
+    def __len__(self):
+        return len(self.users)
+
+    def train_size(self, index):
+        return user_size(self.data[2][self.users[index]]['y'])
+
+    def test_size(self, index):
+        return len(self.data[3][self.users[index]]['y'])
+
+    def read_user_data(self, index):
+        if self.lazy:
+            return read_user_data(index, self.data, self.dataset)
+        return self.cached_data.read_user_data(index)
+
+    def read_federation_data(self):
+        """Tensors of all users concatenated (see CachedData.read_federation_data)"""
+        assert not self.lazy, "Data of all users not kept by a lazy store"
+        return self.cached_data.read_federation_data()
@@ -9,33 +9,39 @@ plt.rcParams.update({'font.size': 14})
 
 
 def read_from_results(file_name):
-    hf = h5py.File(file_name, 'r')
-    string = file_name.split('_')
-    if "norms" in string:
-        rs_param_norms = np.array(hf.get('rs_param_norms')[:])
-        if "SCAFFOLD" in string or "SCAFFOLD-warm" in string:
-            rs_control_norms = np.array(hf.get('rs_control_norms')[:])
-            return rs_param_norms, rs_control_norms
-        else:
-            return rs_param_norms
+    """Reads the results of a run, which can be running or stopped before its end (the results being appended during
+    training, see utils.results_utils.ResultsWriter): metrics of the rounds saved for all of them."""
+    with h5py.File(file_name, 'r', swmr=True) as hf:
+        string = file_name.split('_')
+        if "norms" in string:
+            if "SCAFFOLD" in string or "SCAFFOLD-warm" in string:
+                return read_datasets(hf, ['rs_param_norms', 'rs_control_norms'])
+            else:
+                return read_datasets(hf, ['rs_param_norms'])[0]
+
+        return read_datasets(hf, ['rs_train_acc', 'rs_train_loss', 'rs_glob_acc', 'rs_test_loss', 'rs_train_diss'])
+
+
+def read_datasets(hf, names):
+    """Datasets of an h5 file truncated to the same length"""
+    length = min(len(hf[name]) for name in names)
+    return tuple(np.array(hf.get(name)[:length]) for name in names)
+
 
-    rs_glob_acc = np.array(hf.get('rs_glob_acc')[:])
-    rs_train_acc = np.array(hf.get('rs_train_acc')[:])
-    rs_train_loss = np.array(hf.get('rs_train_loss')[:])
-    rs_test_loss = np.array(hf.get('rs_test_loss')[:])
-    rs_train_diss = np.array(hf.get('rs_train_diss')[:])
-    return rs_train_acc, rs_train_loss, rs_glob_acc, rs_test_loss, rs_train_diss
+def read_rounds(file_name):
+    """Rounds of the metrics of read_from_results (every round for the results saved without them)."""
+    with h5py.File(file_name, 'r', swmr=True) as hf:
+        length = min(len(hf[name]) for name in ['rs_train_acc', 'rs_train_loss', 'rs_glob_acc', 'rs_test_loss',
+                                                 'rs_train_diss'])
+        if 'rs_rounds' in hf:
+            return np.array(hf.get('rs_rounds')[:length])
+        return np.arange(length)
 
 
 def get_all_training_data_value(num_glob_iters, algorithm, dataset, times, similarity, noise, number, dp,
                                 sigma_gaussian, local_updates, sample_ratio, user_ratio, model_name):
-    """Gets the results calculated during training, testing or CV phases."""
-    train_acc = np.zeros((times, num_glob_iters))
-    train_loss = np.zeros((times, num_glob_iters))
-    glob_acc = np.zeros((times, num_glob_iters))
-    test_loss = np.zeros((times, num_glob_iters))
-    train_diss = np.zeros((times, num_glob_iters))
-
+    """Gets the results calculated during training, testing or CV phases (at the evaluated rounds < num_glob_iters
+    saved for all runs, see get_common_rounds)."""
     file_name = "./results/" + model_name + "/" + dataset + "_" + number + '_' + algorithm
     file_name += "_" + str(similarity) + "s"
     file_name += "_" + str(local_updates) + "K"
@@ -46,13 +52,26 @@ def get_all_training_data_value(num_glob_iters, algorithm, dataset, times, simil
     if noise:
         file_name += '_noisy'
 
+    rounds = get_common_rounds(file_name, times, num_glob_iters)
+    train_acc = np.zeros((times, len(rounds)))
+    train_loss = np.zeros((times, len(rounds)))
+    glob_acc = np.zeros((times, len(rounds)))
+    test_loss = np.zeros((times, len(rounds)))
+    train_diss = np.zeros((times, len(rounds)))
+
     for i in range(times):
         f = file_name + "_" + str(i) + ".h5"
         train_acc[i, :], train_loss[i, :], glob_acc[i, :], test_loss[i, :], train_diss[i, :] = np.array(
-            read_from_results(f))[:, :num_glob_iters]
+            read_from_results(f))[:, :len(rounds)]
     return glob_acc, train_acc, train_loss, test_loss, train_diss
 
 
+def get_common_rounds(file_name, times, num_glob_iters):
+    """Evaluated rounds < num_glob_iters of the runs (same schedule), which can be stopped before their end"""
+    rounds = min([read_rounds(file_name + "_" + str(i) + ".h5") for i in range(times)], key=len)
+    return rounds[rounds < num_glob_iters]
+
+
 def average_data(num_glob_iters, algorithm, dataset, times, similarity, noise, number, dp, sigma_gaussian,
                  local_updates, sample_ratio, user_ratio, model_name, cross_validation=False, k_fold=None, nb_fold=None,
                  local_learning_rate=None):
@@ -106,6 +125,7 @@ def average_data(num_glob_iters, algorithm, dataset, times, similarity, noise, n
             file_name += "_" + str(sigma_gaussian) + dp
         if noise:
             file_name += '_noisy'
+        rounds = get_common_rounds(file_name, times, num_glob_iters)
         file_name += "_avg.h5"
 
         if len(glob_acc) != 0 & len(train_acc) & len(train_loss) & len(test_loss):
@@ -115,6 +135,7 @@ def average_data(num_glob_iters, algorithm, dataset, times, similarity, noise, n
                 hf.create_dataset('rs_train_loss', data=train_loss_data)
                 hf.create_dataset('rs_test_loss', data=test_loss_data)
                 hf.create_dataset('rs_train_diss', data=train_diss_data)
+                hf.create_dataset('rs_rounds', data=rounds)
                 hf.close()
         return 0
 
@@ -132,18 +153,21 @@ def get_all_norms(num_glob_iters, algorithm, dataset, times, similarity, noise,
     if noise:
         file_name += '_noisy'
 
-    param_norms = np.zeros((times, num_glob_iters))
+    # rounds saved for all runs
+    nb_rounds = min([np.size(read_from_results(file_name + "_" + str(i) + ".h5"), axis=-1) for i in range(times)] +
+                    [num_glob_iters])
+    param_norms = np.zeros((times, nb_rounds))
 
     if algorithm == "SCAFFOLD" or algorithm == "SCAFFOLD-warm":
-        control_norms = np.zeros((times, num_glob_iters))
+        control_norms = np.zeros((times, nb_rounds))
         for i in range(times):
             f = file_name + "_" + str(i) + ".h5"
-            param_norms[i, :], control_norms[i, :] = np.array(read_from_results(f))[:, :num_glob_iters]
+            param_norms[i, :], control_norms[i, :] = np.array(read_from_results(f))[:, :nb_rounds]
         return param_norms, control_norms
     else:
         for i in range(times):
             f = file_name + "_" + str(i) + ".h5"
-            param_norms[i, :] = np.array(read_from_results(f))[:num_glob_iters]
+            param_norms[i, :] = np.array(read_from_results(f))[:nb_rounds]
         return param_norms
 
 
@@ -341,11 +365,12 @@ def plot_train_dissimilarity(dataset, algorithms, noises, similarities, number,
                     file_name += "_avg.h5"
                     train_acc, train_loss, glob_acc, test_loss, train_diss = np.array(
                         read_from_results(file_name))[:, :]
+                    rounds = read_rounds(file_name)
                     if dp == "None":
-                        axs[k].plot(train_diss, color=color, linestyle='dashed', label=label, alpha=0.6)
+                        axs[k].plot(rounds, train_diss, color=color, linestyle='dashed', label=label, alpha=0.6)
                     else:
                         label = "DP-" + label
-                        axs[k].plot(train_diss, color, label=label)
+                        axs[k].plot(rounds, train_diss, color, label=label)
                     axs[k].legend(loc="lower left")
     plt.show()
 
@@ -413,11 +438,12 @@ def plot_test_accuracy(dataset, algorithms, noises, similarities, number, sigma_
                     file_name += "_avg.h5"
                     train_acc, train_loss, glob_acc, test_loss, train_diss = np.array(
                         read_from_results(file_name))[:, :]
+                    rounds = read_rounds(file_name)
                     if dp == "None":
-                        axs[k].plot(glob_acc, color=color, linestyle='dashed', label=label, alpha=0.6)
+                        axs[k].plot(rounds, glob_acc, color=color, linestyle='dashed', label=label, alpha=0.6)
                     else:
                         label = "DP-" + label
-                        axs[k].plot(glob_acc, color, label=label)
+                        axs[k].plot(rounds, glob_acc, color, label=label)
                     axs[k].legend(loc="lower right")
     plt.show()
 
@@ -489,13 +515,14 @@ def plot_train_loss(dataset, algorithms, noises, similarities, number, sigma_gau
                     file_name += "_avg.h5"
                     train_acc, train_loss, glob_acc, test_loss, train_diss = np.array(
                         read_from_results(file_name))[:, :]
+                    rounds = read_rounds(file_name)
                     if log:
                         train_loss = np.log(train_loss)
                     if dp == "None":
-                        axs[k].plot(train_loss, color=color, linestyle='dashed', label=label, alpha=0.6)
+                        axs[k].plot(rounds, train_loss, color=color, linestyle='dashed', label=label, alpha=0.6)
                     else:
                         label = "DP-" + label
-                        axs[k].plot(train_loss, color, label=label)
+                        axs[k].plot(rounds, train_loss, color, label=label)
                     axs[k].legend(loc="lower left")
     plt.show()
 
@@ -562,10 +589,10 @@ def plot_test_accuracy_multiple_sample_ratio(dataset, algorithms, noises, simila
                         file_name += "_avg.h5"
                         train_acc, train_loss, glob_acc, test_loss, train_diss = np.array(
                             read_from_results(file_name))[:, :]
+                        rounds = read_rounds(file_name)
                         str_sr = ", s={}".format(sample_ratio)
-                        axs[k].plot(glob_acc, color=color, linestyle=linestyle, label=label + str_sr)
-                        length = np.size(glob_acc)
-                        axs[k].axvline(x=length - 1, color='r', linewidth=0.2)
+                        axs[k].plot(rounds, glob_acc, color=color, linestyle=linestyle, label=label + str_sr)
+                        axs[k].axvline(x=rounds[-1], color='r', linewidth=0.2)
                         axs[k].legend(loc="lower right")
     plt.show()
 
@@ -636,12 +663,12 @@ def plot_train_loss_multiple_sample_ratio(dataset, algorithms, noises, similarit
                         file_name += "_avg.h5"
                         train_acc, train_loss, glob_acc, test_loss, train_diss = np.array(
                             read_from_results(file_name))[:, :]
+                        rounds = read_rounds(file_name)
                         if log:
                             train_loss = np.log(train_loss)
                         str_sr = ", s={}".format(sample_ratio)
-                        axs[k].plot(train_loss, color=color, linestyle=linestyle, label=label + str_sr)
-                        length = np.size(glob_acc)
-                        axs[k].axvline(x=length - 1, color='r', linewidth=0.2)
+                        axs[k].plot(rounds, train_loss, color=color, linestyle=linestyle, label=label + str_sr)
+                        axs[k].axvline(x=rounds[-1], color='r', linewidth=0.2)
                         axs[k].legend(loc="lower left")
     plt.show()
 
@@ -708,10 +735,10 @@ def plot_test_accuracy_multiple_user_ratio(dataset, algorithms, noises, similari
                         file_name += "_avg.h5"
                         train_acc, train_loss, glob_acc, test_loss, train_diss = np.array(
                             read_from_results(file_name))[:, :]
+                        rounds = read_rounds(file_name)
                         str_ur = ", l={}".format(user_ratio)
-                        axs[k].plot(glob_acc, color=color, linestyle=linestyle, label=label + str_ur)
-                        length = np.size(glob_acc)
-                        axs[k].axvline(x=length - 1, color='r', linewidth=0.2)
+                        axs[k].plot(rounds, glob_acc, color=color, linestyle=linestyle, label=label + str_ur)
+                        axs[k].axvline(x=rounds[-1], color='r', linewidth=0.2)
                         axs[k].legend(loc="lower right")
     plt.show()
 
@@ -782,12 +809,12 @@ def plot_train_loss_multiple_user_ratio(dataset, algorithms, noises, similaritie
                         file_name += "_avg.h5"
                         train_acc, train_loss, glob_acc, test_loss, train_diss = np.array(
                             read_from_results(file_name))[:, :]
+                        rounds = read_rounds(file_name)
                         if log:
                             train_loss = np.log(train_loss)
                         str_ur = ", l={}".format(user_ratio)
-                        axs[k].plot(train_loss, color=color, linestyle=linestyle, label=label + str_ur)
-                        length = np.size(train_loss)
-                        axs[k].axvline(x=length - 1, color='r', linewidth=0.2)
+                        axs[k].plot(rounds, train_loss, color=color, linestyle=linestyle, label=label + str_ur)
+                        axs[k].axvline(x=rounds[-1], color='r', linewidth=0.2)
                         axs[k].legend(loc="lower left")
     plt.show()
 
@@ -0,0 +1,72 @@
+import os
+import h5py
+
+
+def results_file_name(model_name, dataset, number, algorithm, similarity, local_updates, sample_ratio, user_ratio, dp,
+                      sigma_gaussian, noise, times, name=""):
+    """Name of the h5 file of the results of a run (name: "" for the metrics, "_norms" for the norms), used by the
+    servers to save them (see Server.get_results_file_name) and by the sweeps to find them (see sweep.run_completed)"""
+    file_name = os.path.join("./results", model_name) + "/" + dataset + "_" + str(number) + '_' + algorithm + name
+    file_name += "_" + str(similarity) + "s"
+    file_name += "_" + str(local_updates) + "K"
+    file_name += "_" + str(sample_ratio) + "sr"
+    file_name += "_" + str(user_ratio) + "ur"
+    if dp != "None":
+        file_name += "_" + str(sigma_gaussian) + dp
+    if noise:
+        file_name += '_noisy'
+    file_name += "_" + str(times) + ".h5"
+    return file_name
+
+
+class ResultsWriter:
+    """ Append-only h5 file of results: one resizable dataset per metric, a value being appended to each dataset at
+    every call of append. The file is flushed every flush_every appends and written in SWMR mode, so that the results
+    of a running (or crashed) simulation can be read (see utils.plot_utils.read_from_results). Its attribute
+    'completed' is set at close.
+    :param file_name : h5 file (overwritten)
+    :param names : names of the datasets
+    :param flush_every : nb of appends between two flushes
+    :param attrs : attributes of the file (parameters of the simulation)"""
+
+    def __init__(self, file_name, names, flush_every=10, attrs=None):
+        self.flush_every = flush_every
+        self.length = 0
+        self.file = h5py.File(file_name, 'w', libver='latest')
+        for name in names:
+            self.file.create_dataset(name, shape=(0,), maxshape=(None,), chunks=True,
+                                     dtype='i8' if name == 'rs_rounds' else 'f8')
+        self.file.attrs['completed'] = False
+        for name, value in (attrs or {}).items():
+            self.file.attrs[name] = value
+        self.file.swmr_mode = True
+
+    def append(self, **values):
+        """Appends a value to each dataset (given by name)"""
+        for name, value in values.items():
+            dataset = self.file[name]
+            dataset.resize((self.length + 1,))
+            dataset[self.length] = value
+        self.length += 1
+        if self.length % self.flush_every == 0:
+            self.file.flush()
+
+    def extend(self, **values):
+        """Appends arrays of values (same length) to the datasets (given by name)"""
+        length = self.length + len(next(iter(values.values())))
+        for name, value in values.items():
+            dataset = self.file[name]
+            dataset.resize((length,))
+            dataset[self.length:] = value
+        self.length = length
+        self.file.flush()
+
+    def values(self):
+        """Arrays of the values appended to the datasets"""
+        return {name: dataset[:self.length] for name, dataset in self.file.items()}
+
+    def close(self):
+        if self.file:
+            self.file.attrs['completed'] = True
+            self.file.flush()
+            self.file.close()